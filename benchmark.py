@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+#
+# Benchmarks for the cutting.py export pipeline
+#
+# (C) 2015 Philipp Klaus
+# Licensed under CC-BY-SA-3.0 or GPL-2.0 at your choice.
+
+'''
+Time the stages of the cutting.py export on synthetic documents.
+
+Every case generates an SVG document and exports it like Inkscape would
+(PrepareCutting.affect()), in a fresh Python process, so that the peak
+memory reported is that of the case alone.  The time of every stage is
+taken from the --stats report of the export (see STAGES), so streaming,
+culling, ordering, checkpoints etc. are measured as they run in
+production.  The start up time of the extension (cutting.py --version
+and import cutting, next to a bare interpreter) is reported as well, but
+not part of the total.
+
+No Inkscape is needed to run this, only its Python extension modules
+(inkex, simplepath, cubicsuperpath, ...), which cutting.py looks for in
+the usual install locations; use --extensions to point elsewhere.
+
+Results can be saved with --save and compared against an earlier run
+(e.g. of another revision) with --compare.
+
+  python benchmark.py --save before.json
+  python benchmark.py --compare before.json
+'''
+
+import sys, os, time, json, random, subprocess, tempfile, shutil
+from optparse import OptionParser, SUPPRESS_HELP
+
+
+SVG_HEADER = '<svg xmlns="http://www.w3.org/2000/svg" ' + \
+    'xmlns:xlink="http://www.w3.org/1999/xlink" ' + \
+    'xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape" ' + \
+    'width="3000" height="3000">\n'
+SVG_FOOTER = '</svg>\n'
+
+
+def bezierPathData( rnd, x, y, n ):
+    '''
+    Path data of n random cubic beziers starting at (x, y).
+    '''
+    d = [ 'M %.3f,%.3f' % ( x, y ) ]
+    for i in range( n ):
+        c = [ rnd.uniform( -40, 40 ) for k in range( 6 ) ]
+        d.append( 'c %.3f,%.3f %.3f,%.3f %.3f,%.3f' % tuple( c ) )
+    return ' '.join( d )
+
+
+def genDeepNesting( n ):
+    '''
+    Groups nested n levels deep, each with a transform and a path.
+    '''
+    rnd = random.Random( n )
+    s = [ SVG_HEADER ]
+    for i in range( n ):
+        s.append( '<g transform="translate(%d,%d) rotate(0.5)">\n' % ( i % 7, i % 5 ) )
+        s.append( '<path d="%s"/>\n' % bezierPathData( rnd, 100, 100, 4 ) )
+    s.append( '</g>\n' * n )
+    s.append( SVG_FOOTER )
+    return ''.join( s )
+
+
+def genManyClones( n ):
+    '''
+    n clones of one symbol made of a few paths and primitives.
+    '''
+    rnd = random.Random( n )
+    s = [ SVG_HEADER, '<defs><g id="sym">\n' ]
+    s.append( '<path d="%s"/>\n' % bezierPathData( rnd, 0, 0, 8 ) )
+    s.append( '<circle cx="10" cy="10" r="8"/><rect x="0" y="0" width="20" height="20"/>\n' )
+    s.append( '</g></defs>\n' )
+    for i in range( n ):
+        s.append( '<use xlink:href="#sym" x="%d" y="%d"/>\n' % ( i % 100 * 30, i // 100 * 30 ) )
+    s.append( SVG_FOOTER )
+    return ''.join( s )
+
+
+def genDenseBeziers( n ):
+    '''
+    A single path of n cubic beziers.
+    '''
+    rnd = random.Random( n )
+    return SVG_HEADER + '<path d="%s"/>\n' % bezierPathData( rnd, 1500, 1500, n ) + SVG_FOOTER
+
+
+def genHugePolyline( n ):
+    '''
+    A single polyline with n points.
+    '''
+    rnd = random.Random( n )
+    pts = [ '%.3f,%.3f' % ( rnd.uniform( 0, 3000 ), rnd.uniform( 0, 3000 ) ) for i in range( n ) ]
+    return SVG_HEADER + '<polyline points="%s"/>\n' % ' '.join( pts ) + SVG_FOOTER
+
+
+def genManyLayers( n ):
+    '''
+    n layers with 50 paths each.
+    '''
+    rnd = random.Random( n )
+    s = [ SVG_HEADER ]
+    for i in range( n ):
+        s.append( '<g inkscape:groupmode="layer" inkscape:label="%d layer" id="layer%d">\n' % ( i + 1, i ) )
+        for k in range( 50 ):
+            s.append( '<path d="%s"/>\n' % bezierPathData( rnd, rnd.uniform( 0, 3000 ), rnd.uniform( 0, 3000 ), 4 ) )
+        s.append( '</g>\n' )
+    s.append( SVG_FOOTER )
+    return ''.join( s )
+
+
+# Stages recorded by cutting.py with --stats, in the order they are reported
+STAGES = [ 'parse', 'viewbox', 'traverse', 'cull', 'flatten', 'transform', 'tile',
+           'order', 'convert', 'write', 'cache' ]
+
+# name -> (generator, default size)
+CASES = [
+    ( 'deep_nesting', genDeepNesting, 300 ),
+    ( 'many_clones', genManyClones, 2000 ),
+    ( 'dense_beziers', genDenseBeziers, 20000 ),
+    ( 'huge_polyline', genHugePolyline, 200000 ),
+    ( 'many_layers', genManyLayers, 100 ),
+]
+
+
+def peakMemory():
+    '''
+    Peak resident memory of this process in MB, or None if unknown.
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / 1024.0 / 1024.0    # bytes
+    return rss / 1024.0                 # kilobytes
+
+
+def runCase( svgname, exportargs ):
+    '''
+    Export svgname with the given export options and --stats, and return
+    the timings.  Meant to be run in a fresh process (see --run).
+    '''
+    t0 = time.time()
+    import cutting
+    t_import = time.time() - t0
+
+    outdir = tempfile.mkdtemp()
+    try:
+        dumpname = os.path.join( outdir, 'benchmark.dump' )
+        e = cutting.PrepareCutting()
+        e.tty = open( os.devnull, 'w' )
+        t = time.time()
+        e.affect( [ '--stats=true', '--output=' + dumpname ] + exportargs + [ svgname ], output=False )
+        total = time.time() - t
+        with open( dumpname + '.stats.json' ) as f:
+            stats = json.load( f )
+    finally:
+        shutil.rmtree( outdir )
+
+    stages = dict( stats['stages'], **{ 'import': t_import } )
+    pointcount = stats['counters'].get( 'points', 0 )
+    return {
+        'stages': stages,
+        'total': total,
+        'points': pointcount,
+        'paths': stats['counters'].get( 'paths', 0 ),
+        'points_per_second': pointcount / total if total else None,
+        'peak_memory_mb': peakMemory(),
+    }
+
+
+def childEnvironment( extensions ):
+    env = dict( os.environ )
+    path = [ os.path.dirname( os.path.abspath( __file__ ) ) ]
+    if extensions:
+        path.append( extensions )
+    if env.get( 'PYTHONPATH' ):
+        path.append( env['PYTHONPATH'] )
+    env['PYTHONPATH'] = os.pathsep.join( path )
+    return env
+
+
+def runCaseInChild( svgname, exportargs, extensions ):
+    out = subprocess.check_output( [ sys.executable, os.path.abspath( __file__ ),
+                                     '--run', svgname, '--' ] + exportargs,
+                                   env=childEnvironment( extensions ) )
+    return json.loads( out.decode( 'utf-8' ).strip().splitlines()[-1] )
+
+
+def measureStartup( extensions, repeat ):
+    '''
+    Wall time of starting a bare interpreter, of 'cutting.py --version'
+    and of importing cutting, each the fastest of [repeat] runs.
+    '''
+    env = childEnvironment( extensions )
+    cutting = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'cutting.py' )
+    commands = [
+        ( 'interpreter', [ sys.executable, '-c', 'pass' ] ),
+        ( 'version', [ sys.executable, cutting, '--version' ] ),
+        ( 'import', [ sys.executable, '-c', 'import cutting' ] ),
+    ]
+    startup = {}
+    with open( os.devnull, 'w' ) as devnull:
+        for name, command in commands:
+            best = None
+            for i in range( max( repeat, 3 ) ):
+                t = time.time()
+                subprocess.check_call( command, env=env, stdout=devnull )
+                t = time.time() - t
+                if best is None or t < best:
+                    best = t
+            startup[name] = best
+    return startup
+
+
+def revision():
+    try:
+        out = subprocess.check_output( [ 'git', 'describe', '--always', '--dirty' ],
+                                       cwd=os.path.dirname( os.path.abspath( __file__ ) ) )
+        return out.decode( 'utf-8' ).strip()
+    except Exception:
+        return None
+
+
+def report( name, size, r, old=None ):
+    s = r['stages']
+    line = '%-14s %7d %9d pts %8.3fs  (%s)' % ( name, size, r['points'], r['total'],
+        ' '.join( '%s %.3f' % ( stage, s[stage] ) for stage in [ 'import' ] + STAGES if stage in s ) )
+    if r['points_per_second']:
+        line += ' %9.0f pts/s' % r['points_per_second']
+    if r['peak_memory_mb'] is not None:
+        line += ' %7.1f MB' % r['peak_memory_mb']
+    if old is not None and old['total']:
+        line += '  x%.2f' % ( r['total'] / old['total'] )
+    print( line )
+
+
+def main():
+    parser = OptionParser( usage='usage: %prog [options] [case ...] [-- export options]' )
+    parser.add_option( '--scale', type='float', default=1.0,
+            help='Multiply the default size of every case by this factor' )
+    parser.add_option( '--repeat', type='int', default=1,
+            help='Run every case this many times and keep the fastest run' )
+    parser.add_option( '--save', help='Save the results as JSON to this file' )
+    parser.add_option( '--compare', help='Compare with results saved earlier with --save' )
+    parser.add_option( '--extensions', help='Directory with the Inkscape extension modules' )
+    parser.add_option( '--run', help=SUPPRESS_HELP )
+    argv, exportargs = sys.argv[1:], []
+    if '--' in argv:
+        argv, exportargs = argv[:argv.index( '--' )], argv[argv.index( '--' ) + 1:]
+    options, args = parser.parse_args( argv )
+
+    if options.run:
+        print( json.dumps( runCase( options.run, exportargs ) ) )
+        return
+
+    old = {}
+    if options.compare:
+        with open( options.compare ) as f:
+            saved = json.load( f )
+        old = dict( saved['results'], startup=saved.get( 'startup' ) )
+
+    startup = measureStartup( options.extensions, options.repeat )
+    line = 'startup        interpreter %.3fs, cutting.py --version %.3fs, import cutting %.3fs' % (
+        startup['interpreter'], startup['version'], startup['import'] )
+    if old.get( 'startup' ) and old['startup']['import']:
+        line += '  x%.2f' % ( startup['import'] / old['startup']['import'] )
+    print( line )
+
+    results = {}
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name, generate, size in CASES:
+            if args and name not in args:
+                continue
+            size = max( 1, int( size * options.scale ) )
+            svgname = os.path.join( tmpdir, name + '.svg' )
+            with open( svgname, 'w' ) as f:
+                f.write( generate( size ) )
+            best = None
+            for i in range( options.repeat ):
+                r = runCaseInChild( svgname, exportargs, options.extensions )
+                if best is None or r['total'] < best['total']:
+                    best = r
+            best['size'] = size
+            results[name] = best
+            report( name, size, best, old.get( name ) )
+            os.remove( svgname )
+    finally:
+        os.rmdir( tmpdir )
+
+    if options.save:
+        with open( options.save, 'w' ) as f:
+            json.dump( { 'revision': revision(), 'time': time.time(),
+                         'python': sys.version.split()[0], 'exportargs': exportargs,
+                         'startup': startup, 'results': results }, f, indent=1, sort_keys=True )
+
+
+if __name__ == '__main__':
+    main()
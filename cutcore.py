@@ -0,0 +1,1089 @@
+#!/usr/bin/env python
+#
+# Geometry and output core of the cutting.py Inkscape extension
+#
+# (C) 2015 Philipp Klaus
+# (C) 2014,2015 juewei@fabfolk.com
+# (C) 2013 jw@suse.de. Licensed under CC-BY-SA-3.0 or GPL-2.0 at your choice.
+
+'''
+Everything of the export which does not need the Inkscape extension
+framework (inkex): flattening, simplification, cut ordering, the path
+store and the dump writers and reader.
+
+Nothing slow to load is imported up front.  The Inkscape helper modules
+(bezmisc, cspsubdiv, simplepath, cubicsuperpath, simpletransform) are
+imported on the first flattening, NumPy by loadNumpy() and json by the
+JSON writers, so e.g. reading a binary dump with BinaryCutReader only
+loads this module.
+'''
+
+import sys, os, time, math, re
+import struct, mmap
+from array import array
+
+
+numpy = None            # the numpy module, once loaded by loadNumpy()
+numpyLoaded = False
+
+def loadNumpy():
+
+    '''
+    Import NumPy on first use and return it, or None if it is not
+    installed.  It is optional and takes longer to import than most
+    exports of small documents take.
+    '''
+
+    global numpy, numpyLoaded
+    if not numpyLoaded:
+        numpyLoaded = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
+# Minimum number of coordinates for PathStore.convert() to load NumPy
+CONVERT_NUMPY_MIN = 1 << 16
+
+
+def px2mm(px):
+    '''
+    Convert inkscape pixels to mm.
+    The default inkscape unit, called 'px' is 90dpi
+    '''
+    return px*25.4/90
+
+def mm2px(mm):
+    '''
+    Convert mm to inkscape pixels, the inverse of px2mm().
+    '''
+    return mm*90./25.4
+
+def px2in(px):
+    return px/90.
+
+def mm2in(mm):
+    return mm/25.4
+
+
+def controlPolygonLength( b ):
+
+    """
+    Length of the control polygon of the bezier [b], an upper bound of
+    the length of the curve.
+    """
+
+    return math.hypot( b[1][0] - b[0][0], b[1][1] - b[0][1] ) + \
+           math.hypot( b[2][0] - b[1][0], b[2][1] - b[1][1] ) + \
+           math.hypot( b[3][0] - b[2][0], b[3][1] - b[2][1] )
+
+
+def countFlatPieces( b, flat ):
+
+    """
+    Number of straight pieces flattenCubicPath() would split the bezier
+    [b] into without a step resolution.
+    """
+
+    import cspsubdiv
+    from bezmisc import beziersplitatt
+
+    count = 0
+    stack = [ b ]
+    while stack:
+        b = stack.pop()
+        if cspsubdiv.maxdist( b ) > flat:
+            stack.extend( beziersplitatt( b, 0.5 ) )
+        else:
+            count += 1
+    return count
+
+
+def flattenCubicPath( sp, flat, minstep=0.0, stats=None ):
+
+    """
+    Flatten a cubic superpath into a list of (x, y) points such that
+    every bezier is approximated by straight lines within a given
+    tolerance (the "smoothness" defined by [flat]).
+
+    Pieces shorter than twice [minstep] (the step resolution of the
+    cutter) are not subdivided any further, whatever their deviation, as
+    the cutter could not follow the finer steps anyway.  How often that
+    happened is counted as 'step limited' in [stats], if given, and the
+    points it saved as 'step saved'.
+
+    This replaces the former subdivideCubicPath(), which spliced new
+    nodes into [sp] and therefore did quadratic work on long paths.
+    Each bezier is subdivided at t=0.5 using an explicit stack, in the
+    same depth-first order and with the same cspsubdiv.maxdist()
+    criterion, and only the end points of the flat pieces are appended
+    to a fresh output list.  [sp] is left untouched.
+    """
+
+    import cspsubdiv
+    from bezmisc import beziersplitatt
+
+    if len( sp ) == 0:
+        return []
+
+    limited = saved = 0
+    pts = [ ( sp[0][1][0], sp[0][1][1] ) ]
+    for i in range( 1, len( sp ) ):
+        stack = [ ( sp[i - 1][1], sp[i - 1][2], sp[i][0], sp[i][1] ) ]
+        while stack:
+            b = stack.pop()
+            if cspsubdiv.maxdist( b ) > flat:
+                if minstep > 0 and controlPolygonLength( b ) < 2 * minstep:
+                    limited += 1
+                    if stats is not None:
+                        saved += countFlatPieces( b, flat ) - 1
+                    pts.append( ( b[3][0], b[3][1] ) )
+                    continue
+                one, two = beziersplitatt( b, 0.5 )
+                # push the second half first, so that the first half
+                # is flattened (and emitted) first.
+                stack.append( two )
+                stack.append( one )
+            else:
+                pts.append( ( b[3][0], b[3][1] ) )
+    if limited and stats is not None:
+        stats.count( 'step limited', limited )
+        stats.count( 'step saved', saved )
+    return pts
+
+
+def chordDistanceNumpy( b ):
+
+    """
+    cspsubdiv.maxdist() of all beziers of the (N,4,2) array [b] at once:
+    the largest distance of the two inner control points from the chord
+    between the end points (the segment, not the line).
+    """
+
+    chord = b[:, 3] - b[:, 0]
+    c2 = ( chord * chord ).sum( axis=1 )
+    dist = None
+    for i in ( 1, 2 ):
+        p = b[:, i] - b[:, 0]
+        t = numpy.where( c2 > 0, ( p * chord ).sum( axis=1 ) / numpy.where( c2 > 0, c2, 1.0 ), 0.0 )
+        t = numpy.clip( t, 0.0, 1.0 )[:, None]
+        d = numpy.hypot( *( p - t * chord ).T )
+        dist = d if dist is None else numpy.maximum( dist, d )
+    return dist
+
+
+def flattenCubicPathNumpy( sp, matTransform, flat, minstep=0.0, stats=None ):
+
+    """
+    NumPy variant of flattenCubicPath() which also applies the
+    transformation defined by the matrix [matTransform].
+
+    The beziers of [sp] are held as an (N,4,2) array, transformed with a
+    single matrix multiply and then sampled all at once at uniform
+    parameter steps.  A bezier whose control points lie within [flat] of
+    its chord (the cspsubdiv.maxdist() criterion of flattenCubicPath(),
+    which holds for every straight segment) is a single step.  For the
+    others the number of steps follows from the second differences of
+    the control points (Wang's formula) such that the resulting polyline
+    deviates at most [flat] from the curve.
+
+    The pure Python backend guarantees the same bound, so the polylines
+    of both backends lie within [flat] of the exact curve and thus within
+    2*[flat] of each other.  The number of points differs, as the
+    subdivision is uniform here instead of adaptive.
+
+    Like flattenCubicPath(), no bezier is split into steps shorter than
+    [minstep] (measured along its control polygon).
+    """
+
+    a = numpy.array( sp, dtype=float )          # (N+1, 3, 2)
+    m = numpy.array( matTransform, dtype=float )
+    if len( a ) == 0:
+        return []
+    a = numpy.dot( a, m[:, :2].T ) + m[:, 2]
+    if len( a ) == 1:
+        return [ tuple( a[0, 1].tolist() ) ]
+
+    b = numpy.empty( ( len( a ) - 1, 4, 2 ) )
+    b[:, 0] = a[:-1, 1]
+    b[:, 1] = a[:-1, 2]
+    b[:, 2] = a[1:, 0]
+    b[:, 3] = a[1:, 1]
+
+    dd = numpy.maximum(
+        numpy.hypot( *( b[:, 0] - 2 * b[:, 1] + b[:, 2] ).T ),
+        numpy.hypot( *( b[:, 1] - 2 * b[:, 2] + b[:, 3] ).T ) )
+    n = numpy.ceil( numpy.sqrt( 0.75 * dd / flat ) ).astype( int )
+    n[chordDistanceNumpy( b ) <= flat] = 1
+    if minstep > 0:
+        length = numpy.hypot( *( b[:, 1] - b[:, 0] ).T ) + numpy.hypot( *( b[:, 2] - b[:, 1] ).T ) + \
+                 numpy.hypot( *( b[:, 3] - b[:, 2] ).T )
+        nmax = numpy.floor( length / minstep ).astype( int )
+        if stats is not None:
+            nfull = numpy.maximum( n, 1 )
+            stats.count( 'step limited', int( numpy.count_nonzero( n > numpy.maximum( nmax, 1 ) ) ) )
+            stats.count( 'step saved', int( ( nfull - numpy.maximum( numpy.minimum( n, nmax ), 1 ) ).sum() ) )
+        n = numpy.minimum( n, nmax )
+    n = numpy.maximum( n, 1 )
+
+    seg = numpy.repeat( numpy.arange( len( b ) ), n )
+    k = numpy.arange( len( seg ) ) - numpy.repeat( numpy.cumsum( n ) - n, n ) + 1
+    t = ( k / n[seg].astype( float ) )[:, None]
+    mt = 1.0 - t
+    bs = b[seg]
+    pts = mt * mt * mt * bs[:, 0] + 3 * mt * mt * t * bs[:, 1] + \
+          3 * mt * t * t * bs[:, 2] + t * t * t * bs[:, 3]
+
+    return [ tuple( b[0, 0].tolist() ) ] + [ tuple( pt ) for pt in pts.tolist() ]
+
+
+def parsePathData( d ):
+
+    """
+    Parse the SVG path data [d] into a cubic superpath: a list of
+    subpaths, each a list of [control pt1, node, control pt2] triples.
+    Empty for empty path data.  An element is parsed only once, the
+    result serves superPathBBox() as well as flattenSuperPath().
+    """
+
+    import simplepath, cubicsuperpath
+
+    if not d:
+        return []
+    return cubicsuperpath.CubicSuperPath( simplepath.parsePath( d ) )
+
+
+def flattenPathData( d, matTransform, flat, backend='python', minstep=0.0, stats=None ):
+
+    """
+    Parse the SVG path data [d] and flatten it, see flattenSuperPath().
+    """
+
+    return flattenSuperPath( parsePathData( d ), matTransform, flat, backend, minstep, stats )
+
+
+def flattenSuperPath( p, matTransform, flat, backend='python', minstep=0.0, stats=None ):
+
+    """
+    Apply the transformation [matTransform] to the cubic superpath [p]
+    (see parsePathData()), in place, and flatten it with tolerance
+    [flat], without going below steps of [minstep].  Returns a list of
+    polylines, one per subpath.  The beziers and the time spent
+    transforming are recorded in [stats], if given.
+    """
+
+    from simpletransform import applyTransformToPath
+
+    if len( p ) == 0:
+        return []
+
+    if stats is not None:
+        stats.count( 'beziers', sum( max( len( sp ) - 1, 0 ) for sp in p ) )
+
+    if backend == 'numpy' and loadNumpy() is not None:
+        # transform and flatten each subpath in one batch
+        return [ flattenCubicPathNumpy( sp, matTransform, flat, minstep, stats ) for sp in p ]
+
+    # apply the transformation to each point
+    if stats is not None:
+        with stats.stage( 'transform' ):
+            applyTransformToPath( matTransform, p )
+    else:
+        applyTransformToPath( matTransform, p )
+
+    # p is now a list of lists of cubic beziers [control pt1, control pt2, endpoint]
+    # where the start-point is the last point in the previous segment.
+    return [ flattenCubicPath( sp, flat, minstep, stats ) for sp in p ]
+
+
+def flattenPathDataArgs( args ):
+
+    """
+    flattenPathData() of the tuple [args] or, if its path data has been
+    parsed already, flattenSuperPath().  These are module level
+    functions, so that they can run in the worker processes of the
+    parallel mode.
+    """
+
+    if isinstance( args[0], basestring ):
+        return flattenPathData( *args )
+    return flattenSuperPath( *args )
+
+
+def transformScale( mat ):
+
+    """
+    Return the largest factor by which the transformation [mat] stretches
+    a length, i.e. the largest singular value of its linear part.
+    """
+
+    a, b = mat[0][0], mat[0][1]
+    c, d = mat[1][0], mat[1][1]
+    t = a * a + b * b + c * c + d * d
+    det = a * d - b * c
+    return math.sqrt( ( t + math.sqrt( max( t * t - 4 * det * det, 0.0 ) ) ) / 2 )
+
+
+def transformPoints( mat, pts ):
+
+    """
+    Apply the transformation [mat] to a list of (x, y) points and
+    return the transformed points as a new list.
+    """
+
+    a, b, c = mat[0]
+    d, e, f = mat[1]
+    return [ ( a * x + b * y + c, d * x + e * y + f ) for x, y in pts ]
+
+
+NUMBER_RE = re.compile( r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?' )
+
+def parsePoints( points ):
+
+    """
+    Parse the points attribute of a <polyline> or <polygon> into a list
+    of (x, y) tuples.  A trailing odd coordinate is ignored.
+    """
+
+    c = [ float( n ) for n in NUMBER_RE.findall( points ) ]
+    return list( zip( c[0:len( c ) - 1:2], c[1::2] ) )
+
+
+def ellipsePolyline( cx, cy, rx, ry, matTransform, flat, minstep=0.0, stats=None ):
+
+    """
+    Closed polyline (in local coordinates) approximating the ellipse with
+    center (cx, cy) and radii rx, ry such that, after applying the
+    transformation [matTransform], no chord deviates more than [flat] from
+    the ellipse, unless the chords would get shorter than [minstep].
+
+    The ellipse is the image of the unit circle under the linear map
+    [matTransform] * diag(rx, ry); with n uniform steps a chord of the unit
+    circle deviates 1 - cos(pi/n), so n follows from the largest stretch
+    of that map.  Like the former two-arc conversion, the polyline starts
+    at (cx - rx, cy) and runs through (cx, cy + ry) first.
+
+    Points left out for [minstep] are counted in [stats], if given, like
+    in flattenCubicPath().
+    """
+
+    r = transformScale( [ [ matTransform[0][0] * rx, matTransform[0][1] * ry, 0.0 ],
+                          [ matTransform[1][0] * rx, matTransform[1][1] * ry, 0.0 ] ] )
+    n = 4
+    if flat < r:
+        n = max( n, int( math.ceil( math.pi / math.acos( 1 - flat / r ) ) ) )
+    if minstep > 0:
+        nfull = n
+        n = max( 4, min( n, int( 2 * math.pi * r / minstep ) ) )
+        if n < nfull and stats is not None:
+            stats.count( 'step limited' )
+            stats.count( 'step saved', nfull - n )
+    pts = []
+    for k in range( n ):
+        a = math.pi - 2 * math.pi * k / n
+        pts.append( ( cx + rx * math.cos( a ), cy + ry * math.sin( a ) ) )
+    pts.append( pts[0] )
+    return pts
+
+
+def segmentDistance( p, a, b ):
+
+    """
+    Distance of point [p] from the line segment [a]-[b].
+    """
+
+    dx = b[0] - a[0]
+    dy = b[1] - a[1]
+    l2 = dx * dx + dy * dy
+    if l2 == 0:
+        return math.hypot( p[0] - a[0], p[1] - a[1] )
+    t = ( ( p[0] - a[0] ) * dx + ( p[1] - a[1] ) * dy ) / float( l2 )
+    t = min( max( t, 0.0 ), 1.0 )
+    return math.hypot( p[0] - a[0] - t * dx, p[1] - a[1] - t * dy )
+
+
+def simplifyPolyline( pts, tol ):
+
+    """
+    Ramer-Douglas-Peucker simplification of the polyline [pts]: drops
+    repeated points and every point whose removal moves the polyline by
+    at most [tol].  The first and last point are always kept.
+    """
+
+    if len( pts ) < 3:
+        return pts
+    q = [ pts[0] ]
+    for p in pts[1:]:
+        if p != q[-1]:
+            q.append( p )
+    if len( q ) < 3:
+        return q
+
+    keep = [ False ] * len( q )
+    keep[0] = keep[-1] = True
+    stack = [ ( 0, len( q ) - 1 ) ]
+    while stack:
+        i, j = stack.pop()
+        dmax = -1.0
+        k = -1
+        for m in range( i + 1, j ):
+            d = segmentDistance( q[m], q[i], q[j] )
+            if d > dmax:
+                dmax, k = d, m
+        if dmax > tol:
+            keep[k] = True
+            stack.append( ( i, k ) )
+            stack.append( ( k, j ) )
+    return [ q[m] for m in range( len( q ) ) if keep[m] ]
+
+
+def isClosedPath( path, eps=1e-6 ):
+
+    """
+    True if the polyline [path] ends where it starts.
+    """
+
+    return len( path ) > 2 and abs( path[0][0] - path[-1][0] ) <= eps and \
+        abs( path[0][1] - path[-1][1] ) <= eps
+
+
+def travelDistance( paths, start=( 0.0, 0.0 ) ):
+
+    """
+    Total length of the pen-up moves needed to cut [paths] in the given
+    order and direction, beginning at [start].
+    """
+
+    d = 0.0
+    x, y = start
+    for path in paths:
+        d += math.hypot( path[0][0] - x, path[0][1] - y )
+        x, y = path[-1]
+    return d
+
+
+class EndpointGrid:
+    """
+    Uniform grid over the possible entry points of a set of paths, used
+    to find the nearest entry point of a path not yet cut.  An open path
+    can be entered at either end, a closed path at any of its vertices.
+    Entries of paths marked as done are dropped lazily.
+    """
+    def __init__( self, paths, indices ):
+        entries = []
+        for i in indices:
+            path = paths[i]
+            if isClosedPath( path ):
+                for k in range( len( path ) - 1 ):
+                    entries.append( ( path[k][0], path[k][1], i, k ) )
+            else:
+                entries.append( ( path[0][0], path[0][1], i, 0 ) )
+                entries.append( ( path[-1][0], path[-1][1], i, -1 ) )
+        self.count = len( indices )
+        xs = [ e[0] for e in entries ]
+        ys = [ e[1] for e in entries ]
+        self.x0 = min( xs )
+        self.y0 = min( ys )
+        w = max( xs ) - self.x0
+        h = max( ys ) - self.y0
+        # about one entry per cell
+        self.size = max( math.sqrt( w * h / len( entries ) ), w / len( entries ), h / len( entries ), 1e-9 )
+        self.nx = int( w / self.size ) + 1
+        self.ny = int( h / self.size ) + 1
+        self.cells = {}
+        for e in entries:
+            self.cells.setdefault( self.cell( e[0], e[1] ), [] ).append( e )
+
+    def cell( self, x, y ):
+        cx = min( max( int( ( x - self.x0 ) / self.size ), 0 ), self.nx - 1 )
+        cy = min( max( int( ( y - self.y0 ) / self.size ), 0 ), self.ny - 1 )
+        return cx, cy
+
+    def nearest( self, x, y, done ):
+        """
+        Return (path index, vertex index) of the entry point nearest
+        to (x, y), skipping paths for which done[] is set.
+        """
+        cx, cy = self.cell( x, y )
+        best = None
+        bestd = None
+        r = 0
+        rmax = max( cx, self.nx - 1 - cx, cy, self.ny - 1 - cy )
+        while r <= rmax:
+            for i in range( cx - r, cx + r + 1 ):
+                for j in range( cy - r, cy + r + 1 ):
+                    if r and i != cx - r and i != cx + r and j != cy - r and j != cy + r:
+                        continue    # inside the ring, already searched
+                    entries = self.cells.get( ( i, j ) )
+                    if not entries:
+                        continue
+                    live = [ e for e in entries if not done[e[2]] ]
+                    if len( live ) != len( entries ):
+                        self.cells[( i, j )] = live
+                    for e in live:
+                        d = math.hypot( e[0] - x, e[1] - y )
+                        if bestd is None or d < bestd:
+                            best, bestd = e, d
+            # everything outside this ring is at least r cells away
+            if bestd is not None and bestd <= r * self.size:
+                break
+            r += 1
+        return best[2], best[3]
+
+
+def orderPathsNearest( paths, start=( 0.0, 0.0 ) ):
+
+    """
+    Greedy nearest neighbour ordering of [paths].  Paths are reversed,
+    and closed paths rotated to a different start vertex, where that
+    shortens the pen-up move to them.  Returns a new list of paths.
+    """
+
+    result = []
+    done = [ False ] * len( paths )
+    remaining = len( paths )
+    grid = None
+    x, y = start
+    while remaining:
+        if grid is None or remaining * 4 < grid.count:
+            # rebuild the index once most paths are done, so that the
+            # search does not scan ever more empty cells
+            grid = EndpointGrid( paths, [ i for i in range( len( paths ) ) if not done[i] ] )
+        i, k = grid.nearest( x, y, done )
+        path = paths[i]
+        if k == -1:
+            path = path[::-1]
+        elif k > 0:
+            path = path[k:-1] + path[:k] + [ path[k] ]
+        result.append( path )
+        done[i] = True
+        remaining -= 1
+        x, y = path[-1]
+    return result
+
+
+def improvePathsTwoOpt( paths, timelimit, start=( 0.0, 0.0 ) ):
+
+    """
+    2-opt improvement of the order of [paths]: reversing a run of
+    consecutive paths (and the direction of each of them) is accepted
+    whenever it shortens the pen-up travel.  Stops when no improving move
+    is left or after [timelimit] seconds.  Returns a new list of paths.
+    """
+
+    n = len( paths )
+    S = [ p[0] for p in paths ]     # entry point of the k-th path
+    E = [ p[-1] for p in paths ]    # exit point of the k-th path
+    order = list( range( n ) )
+    rev = [ False ] * n
+    dist = lambda a, b: math.hypot( a[0] - b[0], a[1] - b[1] )
+
+    deadline = time.time() + timelimit
+    improved = True
+    while improved and time.time() < deadline:
+        improved = False
+        for i in range( n - 1 ):
+            if time.time() >= deadline:
+                break
+            prev = E[i - 1] if i > 0 else start
+            dprev = dist( prev, S[i] )
+            for j in range( i + 1, n ):
+                gain = dprev - dist( prev, E[j] )
+                if j + 1 < n:
+                    gain += dist( E[j], S[j + 1] ) - dist( S[i], S[j + 1] )
+                if gain > 1e-9:
+                    S[i:j + 1], E[i:j + 1] = E[i:j + 1][::-1], S[i:j + 1][::-1]
+                    order[i:j + 1] = order[i:j + 1][::-1]
+                    rev[i:j + 1] = [ not r for r in rev[i:j + 1][::-1] ]
+                    dprev = dist( prev, S[i] )
+                    improved = True
+
+    return [ paths[order[k]][::-1] if rev[k] else paths[order[k]] for k in range( n ) ]
+
+
+def pathBBox( path ):
+
+    """
+    Bounding box (xmin, ymin, xmax, ymax) of a polyline.
+    """
+
+    xs = [ p[0] for p in path ]
+    ys = [ p[1] for p in path ]
+    return min( xs ), min( ys ), max( xs ), max( ys )
+
+
+def superPathBBox( p, matTransform ):
+
+    """
+    Bounding box of the cubic superpath [p] (see parsePathData())
+    transformed by [matTransform], taken over all control points, so
+    without flattening anything: every bezier lies within the convex
+    hull of its control points.  None for an empty path.
+    """
+
+    pts = [ ( x, y ) for sp in p for node in sp for x, y in node ]
+    if not pts:
+        return None
+    return pathBBox( transformPoints( matTransform, pts ) )
+
+
+def transformBBox( mat, bbox ):
+
+    """
+    Bounding box of the bounding box [bbox] transformed by [mat].
+    """
+
+    x0, y0, x1, y1 = bbox
+    return pathBBox( transformPoints( mat, [ ( x0, y0 ), ( x1, y0 ), ( x1, y1 ), ( x0, y1 ) ] ) )
+
+
+def boxesOverlap( a, b ):
+
+    """
+    True if the bounding boxes [a] and [b] overlap or touch.
+    """
+
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def clipPolyline( pts, rect ):
+
+    """
+    Clip the polyline [pts] to the rectangle [rect] (xmin, ymin, xmax,
+    ymax) and return the pieces inside, as a list of polylines.  Points
+    inside are kept as they are, points where the polyline crosses the
+    border are added (Liang-Barsky clipping of every segment).
+    """
+
+    if not pts:
+        return []
+    bbox = pathBBox( pts )
+    if rect[0] <= bbox[0] and rect[1] <= bbox[1] and bbox[2] <= rect[2] and bbox[3] <= rect[3]:
+        return [ pts ]
+    if len( pts ) < 2 or not boxesOverlap( bbox, rect ):
+        return []
+
+    x0, y0, x1, y1 = rect
+    pieces = []
+    piece = None
+    for i in range( 1, len( pts ) ):
+        ax, ay = pts[i - 1]
+        bx, by = pts[i]
+        dx = bx - ax
+        dy = by - ay
+        t0 = 0.0
+        t1 = 1.0
+        for p, q in ( ( -dx, ax - x0 ), ( dx, x1 - ax ), ( -dy, ay - y0 ), ( dy, y1 - ay ) ):
+            if p == 0:
+                if q < 0:
+                    t0 = 1.0        # parallel to this border and outside
+                    t1 = 0.0
+                    break
+            elif p < 0:
+                t0 = max( t0, q / float( p ) )
+            else:
+                t1 = min( t1, q / float( p ) )
+        if t0 >= t1:
+            piece = None    # outside, or only touching the border
+            continue
+        if piece is None or t0 > 0:
+            piece = [ pts[i - 1] if t0 == 0 else ( ax + t0 * dx, ay + t0 * dy ) ]
+            pieces.append( piece )
+        if t1 == 1:
+            piece.append( pts[i] )
+        else:
+            piece.append( ( ax + t1 * dx, ay + t1 * dy ) )
+            piece = None
+    return pieces
+
+
+def polygonArea( path ):
+
+    """
+    Unsigned area of the closed polyline [path] (shoelace formula).
+    """
+
+    a = 0.0
+    for i in range( len( path ) - 1 ):
+        a += path[i][0] * path[i + 1][1] - path[i + 1][0] * path[i][1]
+    return abs( a ) / 2
+
+
+def pointInPolygon( x, y, path ):
+
+    """
+    Even-odd test whether (x, y) lies inside the closed polyline [path].
+    """
+
+    inside = False
+    for i in range( len( path ) - 1 ):
+        x1, y1 = path[i]
+        x2, y2 = path[i + 1]
+        if ( y1 > y ) != ( y2 > y ):
+            if x < x1 + ( y - y1 ) * ( x2 - x1 ) / float( y2 - y1 ):
+                inside = not inside
+    return inside
+
+
+def nestingParents( paths ):
+
+    """
+    Containment analysis of [paths].  Returns a list holding for every
+    path the index of the smallest closed path containing it, or -1.
+
+    Only closed paths can contain others.  The bounding boxes of the
+    closed paths are entered into a uniform grid, so that for every path
+    only the closed paths whose bounding box covers its first vertex and
+    its whole bounding box are tested with a point-in-polygon test.
+    """
+
+    bboxes = [ pathBBox( p ) for p in paths ]
+    closed = [ i for i in range( len( paths ) ) if isClosedPath( paths[i] ) ]
+    parents = [ -1 ] * len( paths )
+    if not closed:
+        return parents
+    areas = {}
+    for i in closed:
+        areas[i] = polygonArea( paths[i] )
+
+    x0 = min( b[0] for b in bboxes )
+    y0 = min( b[1] for b in bboxes )
+    w = max( b[2] for b in bboxes ) - x0
+    h = max( b[3] for b in bboxes ) - y0
+    size = max( math.sqrt( w * h / len( paths ) ), w / len( paths ), h / len( paths ), 1e-9 )
+    cells = {}
+    for i in closed:
+        b = bboxes[i]
+        for cx in range( int( ( b[0] - x0 ) / size ), int( ( b[2] - x0 ) / size ) + 1 ):
+            for cy in range( int( ( b[1] - y0 ) / size ), int( ( b[3] - y0 ) / size ) + 1 ):
+                cells.setdefault( ( cx, cy ), [] ).append( i )
+
+    for i in range( len( paths ) ):
+        x, y = paths[i][0]
+        b = bboxes[i]
+        area = areas.get( i, 0.0 )
+        best = -1
+        for j in cells.get( ( int( ( x - x0 ) / size ), int( ( y - y0 ) / size ) ), () ):
+            if j == i or areas[j] <= area:
+                continue
+            if best >= 0 and areas[j] >= areas[best]:
+                continue
+            c = bboxes[j]
+            if c[0] <= b[0] and c[1] <= b[1] and c[2] >= b[2] and c[3] >= b[3] and \
+                    pointInPolygon( x, y, paths[j] ):
+                best = j
+        parents[i] = best
+    return parents
+
+
+class PathStore:
+    """
+    Compact storage for polylines.  The coordinates of all paths are kept
+    in one array('d') as x0, y0, x1, y1, ..., and the index of the first
+    point of every path in an array('l').  Indexing or iterating yields
+    the paths as lists of (x, y) tuples.  The smallest x and y of all
+    points are tracked as they are added (xmin, ymin).
+    """
+    def __init__( self, paths=() ):
+        self.coords = array( 'd' )
+        self.starts = array( 'l' )
+        self.xmin = float( 'inf' )
+        self.ymin = float( 'inf' )
+        for path in paths:
+            self.appendPath( path )
+
+    def __len__( self ):
+        return len( self.starts )
+
+    def pointcount( self ):
+        return len( self.coords ) // 2
+
+    def bounds( self, i ):
+        """
+        Index of the first point of path i and of the point after its last.
+        """
+        if i < 0:
+            i += len( self.starts )
+        if i + 1 < len( self.starts ):
+            return self.starts[i], self.starts[i + 1]
+        return self.starts[i], len( self.coords ) // 2
+
+    def __getitem__( self, i ):
+        if i >= len( self.starts ) or i < -len( self.starts ):
+            raise IndexError( 'path index out of range' )
+        start, end = self.bounds( i )
+        c = self.coords[2 * start:2 * end]
+        return list( zip( c[0::2], c[1::2] ) )
+
+    def __iter__( self ):
+        for i in range( len( self.starts ) ):
+            yield self[i]
+
+    def newPath( self, x, y ):
+        self.starts.append( len( self.coords ) // 2 )
+        self.addPoint( x, y )
+
+    def addPoint( self, x, y ):
+        self.coords.append( x )
+        self.coords.append( y )
+        if x < self.xmin:
+            self.xmin = x
+        if y < self.ymin:
+            self.ymin = y
+
+    def appendPath( self, pts ):
+        self.starts.append( len( self.coords ) // 2 )
+        for x, y in pts:
+            self.addPoint( x, y )
+
+    def clear( self ):
+        del self.coords[:]
+        del self.starts[:]
+        self.xmin = float( 'inf' )
+        self.ymin = float( 'inf' )
+
+    def convert( self, func, xoff=0.0, yoff=0.0 ):
+        """
+        Apply the unit conversion [func] (e.g. px2in) to all coordinates,
+        in place, after translating them by ([xoff], [yoff]).  Long stores
+        are converted through NumPy, if available.
+        """
+        if len( self.coords ) >= CONVERT_NUMPY_MIN and loadNumpy() is not None:
+            a = numpy.frombuffer( self.coords, dtype=float )
+            if xoff or yoff:
+                a[0::2] += xoff
+                a[1::2] += yoff
+            a[:] = func( a )
+            del a           # release the buffer, so that coords can grow again
+        elif xoff or yoff:
+            coords = self.coords
+            for i in range( 0, len( coords ), 2 ):
+                coords[i] = func( coords[i] + xoff )
+                coords[i + 1] = func( coords[i + 1] + yoff )
+        else:
+            coords = self.coords
+            for i in range( len( coords ) ):
+                coords[i] = func( coords[i] )
+
+
+class JsonCutWriter:
+    """
+    Write the cuts as one JSON object {"cuts": [...], "pointcount": N}.
+
+    Paths are serialized from a PathStore, already converted to the output
+    units, as they are handed over, so the complete list of cuts need not
+    be held in memory.  The point count is only known at the end and
+    therefore written after the cuts.
+    """
+    mode = 'w'
+
+    def __init__( self, f ):
+        global json
+        import json
+        self.f = f
+        self.pathcount = 0
+        self.pointcount = 0
+        self.begin()
+
+    def begin( self ):
+        self.f.write( '{"cuts": [' )
+
+    def writePaths( self, store ):
+        for cut in store:
+            self.writeCut( cut )
+            self.pathcount += 1
+            self.pointcount += len( cut )
+
+    def writeCut( self, cut ):
+        if self.pathcount:
+            self.f.write( ', ' )
+        json.dump( cut, self.f )
+
+    def close( self ):
+        self.f.write( '], "pointcount": %d}' % self.pointcount )
+
+
+class NdjsonCutWriter( JsonCutWriter ):
+    """
+    Write the cuts as newline delimited JSON: one {"cut": [...]} object
+    per line, followed by a final {"pointcount": N} line.  A consumer can
+    process each line as soon as it has been written.
+    """
+    def begin( self ):
+        pass
+
+    def writeCut( self, cut ):
+        self.f.write( json.dumps( { 'cut': cut } ) + '\n' )
+
+    def close( self ):
+        self.f.write( json.dumps( { 'pointcount': self.pointcount } ) + '\n' )
+
+
+# Layout of the binary dump, all little-endian:
+#
+#   header   magic 'CUTS', uint16 version, char typecode ('d' float64 or
+#            'f' float32), 1 pad byte, uint64 pathcount, uint64 pointcount,
+#            uint64 file position of the offsets table  (32 bytes)
+#   coords   pointcount (x, y) pairs of the given type, starting at byte 32
+#   offsets  pathcount+1 uint64 point indices; cut i consists of the points
+#            offsets[i] up to (excluding) offsets[i+1]
+BINARY_MAGIC = b'CUTS'
+BINARY_VERSION = 1
+BINARY_HEADER = '<4sHcxQQQ'
+
+class BinaryCutWriter:
+    """
+    Write the cuts in the compact binary layout described above.  The
+    coordinate array of each PathStore handed over is written out as a
+    whole; the offsets table is appended and the header filled in by
+    close().  [f] must be a seekable file opened in binary mode.
+    """
+    mode = 'wb'
+    typecode = 'd'
+
+    def __init__( self, f ):
+        self.f = f
+        self.pathcount = 0
+        self.pointcount = 0
+        self.offsets = [0]
+        self.f.write( self.header( 0 ) )
+
+    def header( self, offsetspos ):
+        return struct.pack( BINARY_HEADER, BINARY_MAGIC, BINARY_VERSION,
+                self.typecode.encode( 'ascii' ), self.pathcount, self.pointcount, offsetspos )
+
+    def writePaths( self, store ):
+        a = store.coords
+        if a.typecode != self.typecode or sys.byteorder == 'big':
+            a = array( self.typecode, a )
+        if sys.byteorder == 'big':
+            a.byteswap()
+        a.tofile( self.f )
+        for i in range( len( store ) ):
+            self.offsets.append( self.pointcount + store.bounds( i )[1] )
+        self.pathcount += len( store )
+        self.pointcount += store.pointcount()
+
+    def close( self ):
+        offsetspos = self.f.tell()
+        self.f.write( struct.pack( '<%dQ' % len( self.offsets ), *self.offsets ) )
+        self.f.seek( 0 )
+        self.f.write( self.header( offsetspos ) )
+        self.f.seek( 0, os.SEEK_END )
+
+
+class Binary32CutWriter( BinaryCutWriter ):
+    """
+    BinaryCutWriter storing float32 instead of float64 coordinates.
+    """
+    typecode = 'f'
+
+
+class PanelCutWriter:
+    """
+    Write cuts split into panels to one dump per panel, each in the
+    format of [writerclass]: panel i (counting from 0) goes to the dump
+    name with ".panel<i+1>" inserted before its extension.  Counts the
+    cuts and points of all panels, like the other writers.
+    """
+    def __init__( self, writerclass, dumpname ):
+        self.writerclass = writerclass
+        self.dumpname = dumpname
+        self.pathcount = 0
+        self.pointcount = 0
+        self.written = []
+
+    def panelName( self, i ):
+        root, ext = os.path.splitext( self.dumpname )
+        return '%s.panel%d%s' % ( root, i + 1, ext )
+
+    def writePanel( self, i, store ):
+        name = self.panelName( i )
+        with open( name, self.writerclass.mode ) as f:
+            writer = self.writerclass( f )
+            writer.writePaths( store )
+            writer.close()
+        self.pathcount += writer.pathcount
+        self.pointcount += writer.pointcount
+        self.written.append( name )
+
+    def close( self ):
+        pass
+
+
+class BinaryCutReader:
+    """
+    Read a dump written by BinaryCutWriter.
+
+    The file is memory mapped.  len() gives the number of cuts and cut(i)
+    returns the points of cut i: a zero-copy (n, 2) array view into the
+    mapping if NumPy is available, a list of (x, y) tuples otherwise.
+    """
+    def __init__( self, filename ):
+        self.f = open( filename, 'rb' )
+        self.mm = mmap.mmap( self.f.fileno(), 0, access=mmap.ACCESS_READ )
+        magic, version, typecode, self.pathcount, self.pointcount, offsetspos = \
+            struct.unpack_from( BINARY_HEADER, self.mm, 0 )
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            raise ValueError( '%s is not a binary cut file (version %d)' % ( filename, BINARY_VERSION ) )
+        self.typecode = typecode.decode( 'ascii' )
+        self.itemsize = struct.calcsize( '<' + self.typecode )
+        n = self.pathcount + 1
+        if loadNumpy() is not None:
+            self.offsets = numpy.frombuffer( self.mm, dtype='<u8', count=n, offset=offsetspos )
+            self.points = numpy.frombuffer( self.mm, dtype='<' + self.typecode,
+                    count=2 * self.pointcount, offset=struct.calcsize( BINARY_HEADER ) ).reshape( -1, 2 )
+        else:
+            self.offsets = struct.unpack_from( '<%dQ' % n, self.mm, offsetspos )
+            self.points = None
+
+    def __len__( self ):
+        return self.pathcount
+
+    def cut( self, i ):
+        start, end = int( self.offsets[i] ), int( self.offsets[i + 1] )
+        if self.points is not None:
+            return self.points[start:end]
+        pos = struct.calcsize( BINARY_HEADER ) + 2 * start * self.itemsize
+        c = struct.unpack_from( '<%d%s' % ( 2 * ( end - start ), self.typecode ), self.mm, pos )
+        return list( zip( c[0::2], c[1::2] ) )
+
+    def close( self ):
+        self.points = None
+        self.offsets = None
+        self.mm.close()
+        self.f.close()
+
+
+def writeAtomically( filename, write, mode='w' ):
+
+    """
+    Write [filename] by calling write(f) with a new temporary file in the
+    same directory, then renaming it to [filename].  The temporary file
+    is created by tempfile.mkstemp(), so no planted file or symlink is
+    written through, and the rename replaces [filename] atomically on
+    POSIX.  Only on Windows, where os.rename() does not replace files,
+    [filename] is removed first.
+    """
+
+    import tempfile
+    fd, tmpname = tempfile.mkstemp( prefix=os.path.basename( filename ) + '.', suffix='.tmp',
+                                    dir=os.path.dirname( filename ) or os.curdir )
+    try:
+        with os.fdopen( fd, mode ) as f:
+            write( f )
+        if sys.platform.startswith( 'win' ) and os.path.exists( filename ):
+            os.remove( filename )
+        os.rename( tmpname, filename )
+    except:
+        os.remove( tmpname )
+        raise
+
+
+CUT_WRITERS = {
+    'json': JsonCutWriter,
+    'ndjson': NdjsonCutWriter,
+    'binary': BinaryCutWriter,
+    'binary32': Binary32CutWriter,
+}
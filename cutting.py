@@ -9,7 +9,14 @@
 __version__ = '0.1'	# Keep in sync with cutting.inx ca line 42
 __author__ = 'Philipp Klaus <philipp.l.klaus@web.de>'
 
-import sys, os, shutil, time, logging, tempfile
+import sys, os
+
+if __name__ == '__main__' and ( '-V' in sys.argv[1:] or '--version' in sys.argv[1:] ):
+    # answered before loading inkex and everything else
+    print __version__
+    sys.exit(0)
+
+import time, math, hashlib, bisect, re
 
 
 # we sys.path.append() the directory where this
@@ -29,32 +36,23 @@ else:   # linux
 
 # We will use the inkex module with the predefined Effect base class.
 import inkex
-from bezmisc import *
-from simpletransform import *
-import simplepath
-import cubicsuperpath
-import cspsubdiv
-import string   # for string.lstrip
+from simpletransform import parseTransform, composeTransform
 import gettext
 from optparse import SUPPRESS_HELP
-import json
-
+from array import array
 
-N_PAGE_WIDTH = 3200
-N_PAGE_HEIGHT = 800
+# geometry and output, without inkex; NumPy is loaded by loadNumpy()
+from cutcore import loadNumpy, px2mm, mm2px, px2in, transformScale, transformPoints, \
+    parsePathData, flattenSuperPath, flattenPathDataArgs, flattenCubicPath, flattenCubicPathNumpy, \
+    parsePoints, ellipsePolyline, simplifyPolyline, pathBBox, superPathBBox, transformBBox, \
+    boxesOverlap, clipPolyline, travelDistance, orderPathsNearest, improvePathsTwoOpt, \
+    nestingParents, PathStore, PanelCutWriter, CUT_WRITERS, writeAtomically
 
-def px2mm(px):
-    '''
-    Convert inkscape pixels to mm.
-    The default inkscape unit, called 'px' is 90dpi
-    '''
-    return px*25.4/90
 
-def px2in(px):
-    return px/90.
+IDENTITY_TRANSFORM = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]
 
-def mm2in(mm):
-    return mm/25.4
+N_PAGE_WIDTH = 3200
+N_PAGE_HEIGHT = 800
 
 # Lifted with impunity from eggbot.py
 def parseLengthWithUnits( str ):
@@ -85,39 +83,339 @@ def parseLengthWithUnits( str ):
     return v, u
 
 
-def subdivideCubicPath( sp, flat, i=1 ):
+# Attributes defining the geometry of path-like elements, see geometryKey()
+GEOMETRY_ATTRIBUTES = ( 'd', 'points', 'x', 'y', 'width', 'height',
+                        'x1', 'y1', 'x2', 'y2', 'cx', 'cy', 'r', 'rx', 'ry' )
 
-    """
-    Break up a bezier curve into smaller curves, each of which
-    is approximately a straight line within a given tolerance
-    (the "smoothness" defined by [flat]).
+# Format of the checkpoint written with --checkpoint, see saveCheckpoint()
+CHECKPOINT_VERSION = 1
 
-    This is a modified version of cspsubdiv.cspsubdiv() rewritten
-    to avoid recurrence.
+# Seconds between updates of the checkpoint while exporting
+CHECKPOINT_INTERVAL = 1.0
+
+# Options which change what the path-like elements are numbered, or how
+# many points are written for them: a checkpoint only applies to an
+# export with the same values, see documentHash()
+CHECKPOINT_OPTIONS = ( 'ids', 'layers', 'split_layers', 'offpage', 'smoothness', 'tolerance',
+                       'resolution', 'simplify', 'backend' )
+
+# Bump the second entry when the flattening changes within a release
+GEOMETRY_CACHE_VERSION = ( __version__, 1 )
+
+def geometryKey( node, matTransform, flat, minstep, backend ):
+
+    """
+    Hash over everything the flattened geometry of a path-like element
+    depends on: its tag and geometry attributes, the composed transform
+    and the flattening settings.
     """
 
-    while True:
-        while True:
-            if i >= len( sp ):
+    h = hashlib.sha1()
+    h.update( repr( ( node.tag, [ node.get( a ) for a in GEOMETRY_ATTRIBUTES ],
+                      matTransform, flat, minstep, backend ) ).encode( 'utf-8' ) )
+    return h.digest()
+
+
+class GeometryCache:
+    """
+    On-disk cache of the flattened (and transformed) geometry of path-like
+    elements, keyed by geometryKey(), so that a re-export only flattens the
+    elements which changed.
+
+    The file is discarded when it was written by another version.  Each
+    entry remembers the run it was last used in; when saving, the least
+    recently used entries are evicted until the estimated size is below
+    [maxsize] bytes.
+
+    The file starts with a line of JSON: the version, the run and for
+    every entry its key (hex), run and the number of points of each of
+    its polylines.  All coordinates follow as one little-endian float64
+    array, x0, y0, x1, y1, ..., in the order of the entries.  Nothing in
+    it is executed when loading, unlike a pickle.
+    """
+    def __init__( self, filename, maxsize ):
+        self.filename = filename
+        self.maxsize = maxsize
+        self.entries = {}
+        self.run = 0
+        self.hits = 0
+        self.misses = 0
+        try:
+            self.load()
+        except:
+            self.entries = {}       # no usable cache yet
+            self.run = 0
+        self.run += 1
+
+    def load( self ):
+        import json, binascii
+        with open( self.filename, 'rb' ) as f:
+            index = json.loads( f.readline().decode( 'utf-8' ) )
+            if index['version'] != list( GEOMETRY_CACHE_VERSION ):
                 return
+            coords = array( 'd' )
+            coords.fromstring( f.read() )
+        if sys.byteorder == 'big':
+            coords.byteswap()
+        pos = 0
+        for key, run, lengths in index['entries']:
+            polylines = []
+            for n in lengths:
+                c = coords[pos:pos + 2 * n]
+                polylines.append( list( zip( c[0::2], c[1::2] ) ) )
+                pos += 2 * n
+            self.entries[binascii.unhexlify( key )] = ( run, polylines )
+        if pos != len( coords ):
+            raise ValueError( 'truncated geometry cache' )
+        self.run = index['run']
+
+    def get( self, key ):
+        entry = self.entries.get( key )
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = ( self.run, entry[1] )
+        return entry[1]
+
+    def put( self, key, polylines ):
+        self.entries[key] = ( self.run, polylines )
+
+    def save( self ):
+        size = 0
+        entries = sorted( self.entries.items(), key=lambda e: e[1][0], reverse=True )
+        for i in range( len( entries ) ):
+            size += 64 + sum( 16 * len( pts ) + 64 for pts in entries[i][1][1] )
+            if size > self.maxsize:
+                for key, entry in entries[i:]:
+                    del self.entries[key]
+                break
 
-            p0 = sp[i - 1][1]
-            p1 = sp[i - 1][2]
-            p2 = sp[i][0]
-            p3 = sp[i][1]
+        import json, binascii
+        index = []
+        coords = array( 'd' )
+        for key, ( run, polylines ) in self.entries.items():
+            index.append( ( binascii.hexlify( key ).decode( 'ascii' ), run,
+                            [ len( pts ) for pts in polylines ] ) )
+            for pts in polylines:
+                for x, y in pts:
+                    coords.append( x )
+                    coords.append( y )
+        if sys.byteorder == 'big':
+            coords.byteswap()
+
+        def write( f ):
+            header = json.dumps( { 'version': GEOMETRY_CACHE_VERSION, 'run': self.run,
+                                   'entries': index }, separators=( ',', ':' ) )
+            f.write( header.encode( 'utf-8' ) + b'\n' )
+            coords.tofile( f )
+        writeAtomically( self.filename, write, 'wb' )
+
+
+class Stats:
+    """
+    Wall time per stage and counters of one export, written out with
+    --stats for finding out where the time goes on a particular file.
 
-            b = ( p0, p1, p2, p3 )
+    Stages nest (see stage()); the time of a stage does not include the
+    stages entered while it runs, so the times add up to the total.
+    """
+    def __init__( self ):
+        self.times = {}
+        self.counters = {}
+        self.tags = {}
+        self.stack = []
+        self.started = None
+
+    def enter( self, name ):
+        now = time.time()
+        if self.stack:
+            self.add( self.stack[-1], now - self.started )
+        self.stack.append( name )
+        self.started = now
+
+    def leave( self ):
+        now = time.time()
+        self.add( self.stack.pop(), now - self.started )
+        self.started = now
+
+    def add( self, name, seconds ):
+        self.times[name] = self.times.get( name, 0.0 ) + seconds
+
+    def stage( self, name ):
+        """
+        Time a stage:  with stats.stage( 'flatten' ): ...
+        """
+        self.enter( name )
+        return self
 
-            if cspsubdiv.maxdist( b ) > flat:
-                break
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *exc ):
+        self.leave()
+
+    def count( self, name, n=1 ):
+        self.counters[name] = self.counters.get( name, 0 ) + n
+
+    def countTag( self, tag ):
+        self.tags[tag] = self.tags.get( tag, 0 ) + 1
+
+    def report( self ):
+        tags = {}
+        for tag, n in self.tags.items():
+            if not isinstance( tag, basestring ):
+                continue        # comments and processing instructions
+            name = tag.split( '}' )[-1]
+            tags[name] = tags.get( name, 0 ) + n
+        return { 'stages': self.times, 'total': sum( self.times.values() ),
+                 'counters': self.counters, 'elements': tags }
+
+
+class NoStats( Stats ):
+    """
+    Stand-in for Stats when --stats is off: records no times.  The
+    counters are still kept, as some of them are logged.
+    """
+    def enter( self, name ):
+        pass
+
+    def leave( self ):
+        pass
+
+    def countTag( self, tag ):
+        pass
+
+
+# Class -> { fully qualified element tag: name of the method handling such
+# elements }, see tagHandlers() and recursivelyTraverseSvg().
+TAG_HANDLERS = {}
 
-            i += 1
+def svgTags( *names ):
 
-        one, two = beziersplitatt( b, 0.5 )
-        sp[i - 1][2] = one[1]
-        sp[i][0] = two[2]
-        p = [one[2], one[3], two[1]]
-        sp[i:1] = [p]
+    """
+    All spellings of the given element names: in the svg namespace and
+    without namespace.  A name may also be given as (name, namespace).
+    """
+
+    tags = []
+    for name in names:
+        if isinstance( name, tuple ):
+            name, ns = name
+        else:
+            ns = 'svg'
+        tags.append( inkex.addNS( name, ns ) )
+        tags.append( name )
+    return tags
+
+ELLIPSE_TAGS = svgTags( 'ellipse' )
+GROUP_TAGS = svgTags( 'g' )
+POLYGON_TAGS = svgTags( 'polygon' )
+
+# Elements the cuts never depend on, with all their contents, and the
+# attributes of all other elements they may depend on, see documentHash()
+UNCUT_TAGS = svgTags( 'metadata', ( 'namedview', 'sodipodi' ), 'title', 'desc' )
+OUTPUT_ATTRIBUTES = GEOMETRY_ATTRIBUTES + ( 'transform', 'viewBox', 'style', 'visibility', 'id',
+    inkex.addNS( 'href', 'xlink' ), inkex.addNS( 'groupmode', 'inkscape' ), inkex.addNS( 'label', 'inkscape' ) )
+
+def documentHash( root, options ):
+
+    """
+    Hash over everything the cuts of the document [root] may depend on:
+    the tags of its elements and their geometry, transforms, visibility
+    and references, and the CHECKPOINT_OPTIONS of [options].  Unlike a
+    hash of the whole file it does not change when only the view (window
+    size, zoom, current layer) or the metadata saved with it changed.
+    """
+
+    h = hashlib.sha1()
+    stack = [ root ]
+    while stack:
+        node = stack.pop()
+        if not isinstance( node.tag, basestring ) or node.tag in UNCUT_TAGS:
+            continue        # comments and processing instructions, or nothing to cut
+        h.update( repr( ( node.tag, [ node.get( a ) for a in OUTPUT_ATTRIBUTES ] ) ).encode( 'utf-8' ) )
+        stack.extend( reversed( node ) )
+    h.update( repr( [ getattr( options, name ) for name in CHECKPOINT_OPTIONS ] ).encode( 'utf-8' ) )
+    return h.hexdigest()
+
+def handles( *names ):
+
+    """
+    Decorator marking a method as the handler of the elements with the
+    given names (see svgTags()).  The method is called with the node, its
+    composed transform and its visibility.  A subclass can override a
+    handler like any other method, or mark its own methods as handlers
+    for further element types.
+    """
+
+    def register( method ):
+        method.handledTags = svgTags( *names )
+        return method
+    return register
+
+
+def tagHandlers( cls ):
+
+    """
+    The handler table of [cls]: the methods marked with @handles() in the
+    class and its base classes, by name, so that overriding methods are
+    found.  Built once per class.
+    """
+
+    table = TAG_HANDLERS.get( cls )
+    if table is None:
+        import inspect
+        table = {}
+        for base in reversed( inspect.getmro( cls ) ):
+            for name, value in vars( base ).items():
+                for tag in getattr( value, 'handledTags', () ):
+                    table[tag] = name
+        TAG_HANDLERS[cls] = table
+    return table
+
+
+# Number a layer label starts with, see Layer
+LAYER_NUMBER_RE = re.compile( r'\s*(\d+)\s*' )
+
+class Layer:
+    """
+    Entry of the layer index (see PrepareCutting.buildLayerIndex()): a
+    group with inkscape:groupmode="layer", its position among the layers
+    in document order (from 1), its label, the number the label starts
+    with (None if it does not) and whether it is exported.
+    """
+    def __init__( self, node, position ):
+        self.node = node
+        self.position = position
+        self.label = node.get( inkex.addNS( 'label', 'inkscape' ) ) or ''
+        m = LAYER_NUMBER_RE.match( self.label )
+        self.number = int( m.group( 1 ) ) if m else None
+        self.name = self.label[m.end():] if m else self.label.strip()
+        self.selected = True
+
+    def matches( self, key ):
+        """
+        Whether the --layers entry [key] refers to this layer: its
+        number, its label or its label without the number.
+        """
+        if key.isdigit() and self.number == int( key ):
+            return True
+        key = key.lower()
+        return key == self.label.strip().lower() or key == self.name.lower()
+
+
+class LayerOutput:
+    """
+    The dump of one layer with --split-layers: the file, its writer and
+    the cuts of the layer not written yet.
+    """
+    def __init__( self, layer, dumpname, writerclass ):
+        self.layer = layer
+        self.dumpname = dumpname
+        self.f = open( dumpname, writerclass.mode )
+        self.writer = writerclass( self.f )
+        self.paths = PathStore()
 
 
 class PrepareCutting(inkex.Effect):
@@ -128,46 +426,95 @@ class PrepareCutting(inkex.Effect):
       # Call the base class constructor.
       inkex.Effect.__init__(self)
   
-      self.cuts = []
-      self.warnings = {}
       self.handle = 255
-      self.pathcount = 0
-      self.resumeMode = False
-      self.bStopped = False
-      self.plotCurrentLayer = True
-      self.allLayers = True               # True: all except hidden layers. False: only selected layers.
       self.step_scaling_factor = 1        # see also px2mm()
-      self.ptFirst = None
-      self.fPrevX = None
-      self.fPrevY = None
-      self.fX = None
-      self.fY = None
-      self.svgLastPath = 0
-      self.nodeCount = 0
+      self.stats = NoStats()              # Stats of the current export, with --stats
+      self.resetState()
   
-      self.paths = []
-      self.transforms = {}
-      # For handling an SVG viewbox attribute, we will need to know the
-      # values of the document's <svg> width and height attributes as well
-      # as establishing a transform from the viewbox to the display.
-      self.docWidth = float( N_PAGE_WIDTH )
-      self.docHeight = float( N_PAGE_HEIGHT )
-      self.docTransform = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]
-  
-      self.dumpname = os.path.join(tempfile.gettempdir(), "silhouette.dump")
- 
-      try:
-        self.tty = open("/dev/tty", 'w')
-      except:
-        self.tty = open(os.devnull, 'w')  # '/dev/null' for POSIX, 'nul' for Windows.
+      self.dumpname = None                # --output, or silhouette.dump in the temp directory
+      self.tty = None                     # opened by log(), on the first message
  
       self.OptionParser.add_option('--active-tab', action='store', dest='active_tab',
             help=SUPPRESS_HELP)
       self.OptionParser.add_option('-a', '--autocrop',
             action='store', dest='autocrop', type='inkbool', default=False,
             help='trim away top and left margin (before adding offsets)')
+      self.OptionParser.add_option('--batch', action='store_true', dest='batch', default=False,
+            help='Export all given files (directories: their *.svg files, -: file names ' +
+                 'read from stdin), each to its own dump, see --outdir')
+      self.OptionParser.add_option('--backend', action='store', type='choice',
+            choices=['python', 'numpy'], dest='backend', default='python',
+            help="Flattening backend: 'python' (default) or 'numpy' (batched, needs NumPy)")
+      self.OptionParser.add_option('--format', action='store', type='choice',
+            choices=['json', 'ndjson', 'binary', 'binary32'], dest='format', default='json',
+            help="Format of the dump: 'json' (default), 'ndjson' (one cut per line), " +
+                 "'binary' or 'binary32' (float64/float32 coordinates, see BinaryCutReader)")
+      self.OptionParser.add_option('--inner-first', '--inner_first', action='store',
+            type='inkbool', dest='inner_first', default=False,
+            help='Cut paths before the closed paths that contain them')
+      self.OptionParser.add_option('--checkpoint', action='store', type='inkbool',
+            dest='checkpoint', default=False,
+            help='Record the progress of the export in the dump file name + ".checkpoint", see --resume')
+      self.OptionParser.add_option('--cache', action='store', type='inkbool',
+            dest='cache', default=False,
+            help='Reuse the flattened geometry of elements unchanged since the last export')
+      self.OptionParser.add_option('--cache-size', '--cache_size', action='store', type='float',
+            dest='cache_size', default=64.0,
+            help='Size limit of the geometry cache [MB]')
+      self.OptionParser.add_option('--layers', action='store', type='string',
+            dest='layers', default='',
+            help='Only export these layers: comma separated numbers (the number the label ' +
+                 'starts with) or labels, with or without that number (default: all visible layers)')
+      self.OptionParser.add_option('-j', '--jobs', action='store', type='int',
+            dest='jobs', default=1,
+            help='Flatten paths in this many parallel processes (1: serial); ' +
+                 'with --batch: export this many files in parallel')
+      self.OptionParser.add_option('--offpage', action='store', type='choice',
+            choices=['keep', 'skip', 'clip'], dest='offpage', default='keep',
+            help="Geometry outside the page: 'keep' (default), 'skip' elements entirely " +
+                 "outside the page, or also 'clip' cuts at the page border")
+      self.OptionParser.add_option('-o', '--output', action='store', type='string',
+            dest='output', default=None,
+            help='Write the dump to this file (default: silhouette.dump in the temp directory)')
+      self.OptionParser.add_option('--outdir', action='store', type='string',
+            dest='outdir', default=None,
+            help='With --batch: write the dumps to this directory (default: next to the input files)')
+      self.OptionParser.add_option('--optimize-order', '--optimize_order', action='store',
+            type='inkbool', dest='optimize_order', default=False,
+            help='Reorder (and reverse) cuts to minimize pen-up travel')
+      self.OptionParser.add_option('--optimize-time', '--optimize_time', action='store',
+            type='float', dest='optimize_time', default=2.0,
+            help='Time budget [s] for improving the cut order after nearest neighbour ordering')
+      self.OptionParser.add_option('--panel-length', '--panel_length', action='store', type='float',
+            dest='panel_length', default=0.0,
+            help='Split the cuts into panels of this length [mm] along y (the media feed), each ' +
+                 'written to its own dump as soon as it is complete (0: off)')
+      self.OptionParser.add_option('--resume', action='store', type='inkbool',
+            dest='resume', default=False,
+            help='Only export the cuts after those recorded in the checkpoint (implies --checkpoint)')
+      self.OptionParser.add_option('--resume-points', '--resume_points', action='store', type='int',
+            dest='resume_points', default=-1,
+            help='With --resume: the number of points of the previous dump which were actually cut; ' +
+                 'the export resumes with the element they end in')
       self.OptionParser.add_option( "-S", "--smoothness", action="store", type="float",
-            dest="smoothness", default=.2, help="Smoothness of curves" )
+            dest="smoothness", default=.2, help="Smoothness of curves [px], see also --tolerance" )
+      self.OptionParser.add_option('--tolerance', action='store', type='float',
+            dest='tolerance', default=0.0,
+            help='Maximum deviation of the cuts from curves [mm] at the blade (0: use --smoothness)')
+      self.OptionParser.add_option('--resolution', action='store', type='float',
+            dest='resolution', default=0.0,
+            help='Step resolution of the cutter [mm]: curves are not subdivided into shorter steps (0: off)')
+      self.OptionParser.add_option('--simplify', action='store', type='float',
+            dest='simplify', default=0.0,
+            help='Remove points deviating less than this [mm] from the simplified cut (0: off)')
+      self.OptionParser.add_option('--split-layers', '--split_layers', action='store', type='inkbool',
+            dest='split_layers', default=False,
+            help='Write the cuts of every layer to its own dump: the dump name with ".layerN" ' +
+                 'inserted before the extension, N counting the layers in document order')
+      self.OptionParser.add_option('--stats', action='store', type='inkbool',
+            dest='stats', default=False,
+            help='Write stage timings and counters to the dump file name + ".stats.json" ' +
+                 '(also enabled by the environment variable CUTTING_STATS=1)')
       self.OptionParser.add_option('-V', '--version',
             action='store_const', const=True, dest='version', default=False,
             help='Just print version number ("'+__version__+'") and exit.')
@@ -176,23 +523,113 @@ class PrepareCutting(inkex.Effect):
       self.OptionParser.add_option('-y', '--y-off', '--y_off', action='store',
             type='float', dest='y_off', default=0.0, help="Y-Offset [mm]")
 
+    def setupTolerances( self ):
+      '''
+      Set the flattening tolerance self.flat and the step resolution
+      self.minstep from the options, in px of the output (after all
+      transforms, so the same physical size at the blade, whatever the
+      scaling of the document).
+      '''
+      if self.options.tolerance > 0:
+          self.flat = mm2px( self.options.tolerance )
+      else:
+          self.flat = self.options.smoothness
+      self.minstep = mm2px( self.options.resolution )
+
+    def resetState( self ):
+      '''
+      Forget everything about the previously exported document, so that
+      one instance can export several documents in a row (see --batch).
+      '''
+      self.cuts = []
+      self.warnings = {}
+      self.pathcount = 0
+      self.pointcount = 0
+      self.bStopped = False
+      self.ptFirst = None
+      self.fPrevX = None
+      self.fPrevY = None
+      self.fX = None
+      self.fY = None
+      self.svgLastPath = 0                # path-like elements completed (or skipped when resuming)
+      self.svgLastPathNC = 0              # points exported up to the end of those, see plotPathLike()
+      self.nodeCount = 0                  # points exported before this dump, when resuming
+      self.resumeMode = False
+      self.checkpointing = False          # with --checkpoint or --resume, see saveCheckpoint()
+      self.checkpointName = None
+      self.documentHash = None
+      self.checkpointStart = ( 0, 0 )     # (path, points) this dump starts after
+      self.checkpointStreamed = False     # cuts are written in document order as they are completed
+      self.checkpointEnds = None          # points exported up to the end of every completed element
+      self.checkpointDue = 0.0
+
+      self.paths = PathStore()
+      self.writer = None                  # when set, completed paths are streamed out right away
+      self.deferred = None                # parallel mode: (args, polylines, key, output) per path
+      self.geometryCache = None           # GeometryCache of unchanged elements, with --cache
+      self.transforms = {}                # transform attribute -> parsed matrix
+      self.traversalStack = []            # (children, transform, visibility, onExit), see recursivelyTraverseSvg()
+      self.idIndex = None                 # id -> element, built on the first getElementById()
+      self.useStack = []                  # ids of the <use> targets currently being expanded
+      self.cloneCache = {}                # (id, flat, minstep, scale class) -> (local polylines, step counters)
+      self.cloneCacheHits = 0
+      self.cloneCacheMisses = 0
+      self.simplifyPointsIn = 0
+      self.simplifyPointsOut = 0
+      self.pageRect = None                # with --offpage: (0, 0, docWidth, docHeight)
+      self.clipRect = None                # with --offpage=clip: the page, see plotPoints()
+      self.culledCount = 0
+      self.xShift = 0.0                   # translation [px] applied on conversion, see writePaths()
+      self.panelLength = 0.0              # with --panel-length [px], see tilePaths()
+      self.panels = None                  # panel index -> PathStore of the panels not written yet
+      self.panelLast = {}                 # panel index -> last path-like element reaching into it
+      self.panelScan = False              # True during the first pass, see scanPanels()
+      self.panelOffPage = set()           # path-like elements found off the page by scanPanels()
+      self.panelWriter = None
+      self.layerIndex = {}                # layer group -> Layer, see buildLayerIndex()
+      self.layerVisit = None              # with --layers: the selected layers and their ancestors
+      self.currentLayer = None            # innermost selected layer being traversed
+      self.inSelection = True             # False while only on the way to selected layers
+      self.layerOutputs = None            # with --split-layers: LayerOutput of every layer entered
+      self.yShift = 0.0
+      # For handling an SVG viewbox attribute, we will need to know the
+      # values of the document's <svg> width and height attributes as well
+      # as establishing a transform from the viewbox to the display.
+      self.docWidth = float( N_PAGE_WIDTH )
+      self.docHeight = float( N_PAGE_HEIGHT )
+      self.docTransform = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]
+
+    def parse( self, *args, **kwargs ):
+        if self.options.stats or os.environ.get( 'CUTTING_STATS', '0' ) not in ( '', '0' ):
+            self.stats = Stats()
+        else:
+            self.stats = NoStats()
+        with self.stats.stage( 'parse' ):
+            inkex.Effect.parse( self, *args, **kwargs )
+
     def version(self):
         return __version__
     def author(self):
         return __author__
 
     def log(self, message):
+        if self.tty is None:
+            try:
+                self.tty = open("/dev/tty", 'w')
+            except:
+                self.tty = open(os.devnull, 'w')  # '/dev/null' for POSIX, 'nul' for Windows.
         print >>self.tty, message
 
     def flush_log(self):
-        self.tty.flush()
+        if self.tty is not None:
+            self.tty.flush()
   
     def penUp(self):
         self.fPrevX = None       # flag that we are up
         self.fPrevY = None
   
     def penDown(self):
-        self.paths.append([(self.fX,self.fY)])
+        self.paths.newPath(self.fX, self.fY)
         self.fPrevX = self.fX    # flag that we are down
         self.fPrevY = self.fY
 
@@ -207,114 +644,243 @@ class PrepareCutting(inkex.Effect):
       if ( self.fPrevX is None ):
         return
       # assuming that penDown() was called before.
-      self.paths[-1].append((self.fX,self.fY))
+      self.paths.addPoint(self.fX, self.fY)
 
     ## lifted from eggbot.py, gratefully bowing to the author
-    def plotPath( self, path, matTransform ):
+    def plotPath( self, path, matTransform, key=None, parsed=None ):
         '''
         Plot the path while applying the transformation defined
-        by the matrix [matTransform].
+        by the matrix [matTransform].  The result is stored in the
+        geometry cache under [key], if given.  [parsed] is its path
+        data, if parsed already (see parsePathData()).
         '''
-        # turn this path into a cubicsuperpath (list of beziers)...
-
         d = path.get( 'd' )
 
-        if len( simplepath.parsePath( d ) ) == 0:
+        if self.useStack:
+            # Part of a clone: flatten once in local coordinates and
+            # only transform the points for every further clone.
+            polylines = self.getClonePolylines( path, d, matTransform, parsed )
+            if polylines is not None:
+                with self.stats.stage( 'transform' ):
+                    polylines = [ transformPoints( matTransform, pts ) for pts in polylines ]
+                self.plotPolylines( polylines, key )
+                return
+
+        if self.deferred is not None:
+            # parallel mode: flattened later, in a worker process, which
+            # also parses the path data unless that was needed before
+            args = ( d if parsed is None else parsed, matTransform,
+                     self.flat, self.options.backend, self.minstep )
+            self.deferred.append( ( args, None, key, ( self.paths, self.writer ) ) )
             return
 
-        p = cubicsuperpath.parsePath( d )
+        with self.stats.stage( 'flatten' ):
+            if parsed is None:
+                parsed = parsePathData( d )
+            polylines = flattenSuperPath( parsed, matTransform, self.flat, self.options.backend,
+                                          self.minstep, self.stats )
+        self.plotPolylines( polylines, key )
 
-        # ...and apply the transformation to each point
-        applyTransformToPath( matTransform, p )
+    def plotPolylines( self, polylines, key=None ):
+        '''
+        Plot already flattened and transformed subpaths, and store them
+        in the geometry cache under [key], if given.  In parallel mode
+        they are queued behind the paths still to be flattened.
+        '''
+        if key is not None:
+            self.geometryCache.put( key, polylines )
+        if self.deferred is not None:
+            self.deferred.append( ( None, polylines, None, ( self.paths, self.writer ) ) )
+            return
+        for pts in polylines:
+            self.plotPoints( pts )
 
-        # p is now a list of lists of cubic beziers [control pt1, control pt2, endpoint]
-        # where the start-point is the last point in the previous segment.
-        for sp in p:
+    def plotDeferred( self ):
+        '''
+        Flatten the paths collected by plotPath() in parallel mode in a
+        pool of self.options.jobs worker processes, and plot the results
+        in document order, exactly as the serial mode would have.
+        '''
+        items = self.deferred
+        self.deferred = None
+        output = ( self.paths, self.writer )
+
+        work = [ item[0] for item in items if item[0] is not None ]
+        self.stats.enter( 'flatten' )       # waiting for the workers
+        import multiprocessing
+        pool = multiprocessing.Pool( self.options.jobs )
+        try:
+            results = pool.imap( flattenPathDataArgs, work,
+                                 max( 1, len( work ) // ( 8 * self.options.jobs ) ) )
+            for args, polylines, key, ( self.paths, self.writer ) in items:
+                if args is not None:
+                    polylines = next( results )
+                    if key is not None:
+                        self.geometryCache.put( key, polylines )
+                with self.stats.stage( 'traverse' ):
+                    for pts in polylines:
+                        self.plotPoints( pts )
+        finally:
+            pool.close()
+            pool.join()
+            self.stats.leave()
+
+        self.paths, self.writer = output
+
+    def getClonePolylines( self, path, d, matTransform, parsed=None ):
+        '''
+        Return the subpaths of [path] (with path data [d], or [parsed]
+        already, see parsePathData()) flattened in its local coordinates,
+        with a tolerance that keeps the error within the tolerance after
+        applying [matTransform] (and a step resolution that approximately
+        does).  Results are cached per run and per scale
+        class (the power of two the transform's scale rounds up to, so an
+        unscaled clone keeps the full tolerance), so repeated clones
+        of an element are flattened only once for each zoom factor; the
+        step resolution counters of the first one are counted again for
+        every further clone.  Returns None for degenerate transforms.
+        '''
+        scale = transformScale( matTransform )
+        if scale <= 0:
+            return None
+        sclass = int( math.ceil( math.log( scale, 2 ) - 1e-9 ) )
+        key = ( path.get( 'id' ) or d, self.flat, self.minstep, sclass )
+
+        cached = self.cloneCache.get( key )
+        if cached is not None:
+            self.cloneCacheHits += 1
+            polylines, steps = cached
+            for name, n in steps:
+                self.stats.count( name, n )
+            return polylines
+
+        self.cloneCacheMisses += 1
+        polylines = []
+        before = [ ( name, self.stats.counters.get( name, 0 ) ) for name in ( 'step limited', 'step saved' ) ]
+        # scale is at most 2**sclass for all members of the class
+        flat = self.flat / 2.0 ** sclass
+        minstep = self.minstep / 2.0 ** sclass
+        with self.stats.stage( 'flatten' ):
+            if parsed is None:
+                parsed = parsePathData( d )
+            for sp in parsed:
+                self.stats.count( 'beziers', max( len( sp ) - 1, 0 ) )
+                if self.options.backend == 'numpy' and loadNumpy() is not None:
+                    polylines.append( flattenCubicPathNumpy( sp, [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]],
+                                                             flat, minstep, self.stats ) )
+                else:
+                    polylines.append( flattenCubicPath( sp, flat, minstep, self.stats ) )
+        steps = [ ( name, self.stats.counters.get( name, 0 ) - n ) for name, n in before ]
+        self.cloneCache[key] = ( polylines, steps )
+        return polylines
+
+    def plotPoints( self, pts ):
+        '''
+        Plot a flattened subpath, given as a list of (x, y) points.
+        The pen is lifted before the first point.  With --offpage=clip
+        only the pieces within the page are plotted.
+        '''
+        pieces = [ pts ]
+        if self.clipRect is not None:
+            pieces = clipPolyline( pts, self.clipRect )
+
+        for pts in pieces:
+            if self.options.simplify > 0:
+                self.simplifyPointsIn += len( pts )
+                pts = simplifyPolyline( pts, mm2px( self.options.simplify ) )
+                self.simplifyPointsOut += len( pts )
 
-            subdivideCubicPath( sp, self.options.smoothness )
             nIndex = 0
 
-            for csp in sp:
+            for pt in pts:
 
                 if self.bStopped:
                     return
 
-                if self.plotCurrentLayer:
-                    if nIndex == 0:
-                        self.penUp()
-                        self.virtualPenIsUp = True
-                    elif nIndex == 1:
-                        self.penDown()
-                        self.virtualPenIsUp = False
+                if nIndex == 0:
+                    self.penUp()
+                    self.virtualPenIsUp = True
+                elif nIndex == 1:
+                    self.penDown()
+                    self.virtualPenIsUp = False
 
                 nIndex += 1
 
-                self.fX = float( csp[1][0] ) / self.step_scaling_factor
-                self.fY = float( csp[1][1] ) / self.step_scaling_factor
+                self.fX = float( pt[0] ) / self.step_scaling_factor
+                self.fY = float( pt[1] ) / self.step_scaling_factor
 
                 # store home
                 if self.ptFirst is None:
                     self.ptFirst = ( self.fX, self.fY )
 
-                if self.plotCurrentLayer:
-                    self.plotLineAndTime()
-                    self.fPrevX = self.fX
-                    self.fPrevY = self.fY
+                self.plotLineAndTime()
+                self.fPrevX = self.fX
+                self.fPrevY = self.fY
 
+        self.flushPaths()
 
-    def DoWePlotLayer( self, strLayerName ):
-        """
-        We are only plotting *some* layers. Check to see
-        whether or not we're going to plot this one.
-
-        First: scan first 4 chars of node id for first non-numeric character,
-        and scan the part before that (if any) into a number
-
-        Then, see if the number matches the layer.
-        """
-
-        TempNumString = 'x'
-        stringPos = 1
-        CurrentLayerName = string.lstrip( strLayerName ) #remove leading whitespace
-
-        # Look at layer name.  Sample first character, then first two, and
-        # so on, until the string ends or the string no longer consists of
-        # digit characters only.
-
-        MaxLength = len( CurrentLayerName )
-        if MaxLength > 0:
-            while stringPos <= MaxLength:
-                if str.isdigit( CurrentLayerName[:stringPos] ):
-                    TempNumString = CurrentLayerName[:stringPos] # Store longest numeric string so far
-                    stringPos = stringPos + 1
-                else:
-                    break
+    def flushPaths( self ):
+        '''
+        Hand the completed paths over to the output writer, if
+        they are streamed out, or to their panels with --panel-length.
+        Otherwise they are kept in self.paths.
+        '''
+        if self.panels is not None:
+            self.tilePaths()
+        elif self.writer is not None:
+            self.writePaths( self.writer )
 
-        self.plotCurrentLayer = False    #Temporarily assume that we aren't plotting the layer
-        if ( str.isdigit( TempNumString ) ):
-            if ( self.svgLayer == int( float( TempNumString ) ) ):
-                self.plotCurrentLayer = True    #We get to plot the layer!
-                self.LayersPlotted += 1
-        #Note: this function is only called if we are NOT plotting all layers.
+    def writePaths( self, writer ):
+        '''
+        Convert self.paths to the output units in place, translated by the
+        offsets (see effect()), hand them over to [writer] and empty
+        self.paths.
+        '''
+        with self.stats.stage( 'convert' ):
+            self.paths.convert( px2in, self.xShift, self.yShift )
+        with self.stats.stage( 'write' ):
+            writer.writePaths( self.paths )
+        self.paths.clear()
 
 
-    def recursivelyTraverseSvg( self, aNodeList,
-             matCurrent=[[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]],
+    def recursivelyTraverseSvg( self, aNodeList, matCurrent=None,
              parent_visibility='visible' ):
         """
-        Recursively traverse the svg file to plot out all of the
-        paths.  The function keeps track of the composite transformation
-        that should be applied to each path.
-
-        This function handles path, group, line, rect, polyline, polygon,
-        circle, ellipse and use (clone) elements.  Notable elements not
-        handled include text.  Unhandled elements should be converted to
-        paths in Inkscape.
+        Traverse the svg file to plot out all of the paths.  The function
+        keeps track of the composite transformation that should be applied
+        to each path.
+
+        Every node is dispatched on its tag to the handler marked with
+        @handles() (see tagHandlers()).  Handlers exist for path, group, line, rect, polyline,
+        polygon, circle, ellipse, symbol and use (clone) elements, and for
+        elements that are ignored.  Notable elements not handled include
+        text.  Unhandled elements should be converted to paths in Inkscape.
+
+        Despite the name, the traversal does not recurse: handlers of
+        container elements hand their children to traverseChildren(),
+        which pushes them on an explicit stack, so that the nesting depth
+        of the document is not limited by Python's recursion limit.
         """
-        if not self.plotCurrentLayer:
-            return        # saves us a lot of time ...
+        if matCurrent is None:
+            matCurrent = IDENTITY_TRANSFORM
+
+        handlers = dict( ( tag, getattr( self, name ) )
+                         for tag, name in tagHandlers( self.__class__ ).items() )
+        stack = self.traversalStack
+        depth = len( stack )
+        self.traverseChildren( aNodeList, matCurrent, parent_visibility )
+        while len( stack ) > depth:
+            nodes, matCurrent, parent_visibility, onExit = stack[-1]
+            node = next( nodes, None )
+            if node is None:
+                # all children done: back to the parent element
+                stack.pop()
+                if onExit is not None:
+                    onExit()
+                continue
+
+            self.stats.countTag( node.tag )
 
-        for node in aNodeList:
             # Ignore invisible nodes
             v = node.get( 'visibility', parent_visibility )
             if v == 'inherit':
@@ -323,391 +889,11 @@ class PrepareCutting(inkex.Effect):
                 pass
 
             # first apply the current matrix transform to this node's tranform
-            matNew = composeTransform( matCurrent, parseTransform( node.get( "transform" ) ) )
-
-            if node.tag == inkex.addNS( 'g', 'svg' ) or node.tag == 'g':
-
-                self.penUp()
-                if ( node.get( inkex.addNS( 'groupmode', 'inkscape' ) ) == 'layer' ):
-                    if (node.get('style','') == 'display:none'):
-                        self.plotCurrentLayer = False
-                    else:
-                        self.plotCurrentLayer = True
-
-                    if not self.allLayers:
-                        # inkex.errormsg('Plotting layer named: ' + node.get(inkex.addNS('label', 'inkscape')))
-                        self.DoWePlotLayer( node.get( inkex.addNS( 'label', 'inkscape' ) ) )
-                self.recursivelyTraverseSvg( node, matNew, parent_visibility=v )
-
-            elif node.tag == inkex.addNS( 'use', 'svg' ) or node.tag == 'use':
-
-                # A <use> element refers to another SVG element via an xlink:href="#blah"
-                # attribute.  We will handle the element by doing an XPath search through
-                # the document, looking for the element with the matching id="blah"
-                # attribute.  We then recursively process that element after applying
-                # any necessary (x,y) translation.
-                #
-                # Notes:
-                #  1. We ignore the height and width attributes as they do not apply to
-                #     path-like elements, and
-                #  2. Even if the use element has visibility="hidden", SVG still calls
-                #     for processing the referenced element.  The referenced element is
-                #     hidden only if its visibility is "inherit" or "hidden".
-
-                refid = node.get( inkex.addNS( 'href', 'xlink' ) )
-                if refid:
-                    # [1:] to ignore leading '#' in reference
-                    path = '//*[@id="%s"]' % refid[1:]
-                    refnode = node.xpath( path )
-                    if refnode:
-                        x = float( node.get( 'x', '0' ) )
-                        y = float( node.get( 'y', '0' ) )
-                        # Note: the transform has already been applied
-                        if ( x != 0 ) or (y != 0 ):
-                            matNew2 = composeTransform( matNew, parseTransform( 'translate(%f,%f)' % (x,y) ) )
-                        else:
-                            matNew2 = matNew
-                        v = node.get( 'visibility', v )
-                        self.recursivelyTraverseSvg( refnode, matNew2, parent_visibility=v )
-                    else:
-                        pass
-                else:
-                    pass
-
-            elif node.tag == inkex.addNS( 'path', 'svg' ):
-
-                self.pathcount += 1
-
-                # if we're in resume mode AND self.pathcount < self.svgLastPath,
-                #    then skip over this path.
-                # if we're in resume mode and self.pathcount = self.svgLastPath,
-                #    then start here, and set
-                # self.nodeCount equal to self.svgLastPathNC
-                if self.resumeMode and ( self.pathcount == self.svgLastPath ):
-                        self.nodeCount = self.svgLastPathNC
-                if self.resumeMode and ( self.pathcount < self.svgLastPath ):
-                    pass
-                else:
-                    self.plotPath( node, matNew )
-                    if ( not self.bStopped ):       #an "index" for resuming plots quickly-- record last complete path
-                        self.svgLastPath += 1
-                        self.svgLastPathNC = self.nodeCount
-
-            elif node.tag == inkex.addNS( 'rect', 'svg' ) or node.tag == 'rect':
-
-                # Manually transform
-                #
-                #    <rect x="X" y="Y" width="W" height="H"/>
-                #
-                # into
-                #
-                #    <path d="MX,Y lW,0 l0,H l-W,0 z"/>
-                #
-                # I.e., explicitly draw three sides of the rectangle and the
-                # fourth side implicitly
-
-                self.pathcount += 1
-                # if we're in resume mode AND self.pathcount < self.svgLastPath,
-                #    then skip over this path.
-                # if we're in resume mode and self.pathcount = self.svgLastPath,
-                #    then start here, and set
-                # self.nodeCount equal to self.svgLastPathNC
-                if self.resumeMode and ( self.pathcount == self.svgLastPath ):
-                    self.nodeCount = self.svgLastPathNC
-                if self.resumeMode and ( self.pathcount < self.svgLastPath ):
-                    pass
-                else:
-                    # Create a path with the outline of the rectangle
-                    newpath = inkex.etree.Element( inkex.addNS( 'path', 'svg' ) )
-                    x = float( node.get( 'x' ) )
-                    y = float( node.get( 'y' ) )
-                    w = float( node.get( 'width' ) )
-                    h = float( node.get( 'height' ) )
-                    s = node.get( 'style' )
-                    if s:
-                        newpath.set( 'style', s )
-                    t = node.get( 'transform' )
-                    if t:
-                        newpath.set( 'transform', t )
-                    a = []
-                    a.append( ['M ', [x, y]] )
-                    a.append( [' l ', [w, 0]] )
-                    a.append( [' l ', [0, h]] )
-                    a.append( [' l ', [-w, 0]] )
-                    a.append( [' Z', []] )
-                    newpath.set( 'd', simplepath.formatPath( a ) )
-                    self.plotPath( newpath, matNew )
-
-            elif node.tag == inkex.addNS( 'line', 'svg' ) or node.tag == 'line':
-
-                # Convert
-                #
-                #   <line x1="X1" y1="Y1" x2="X2" y2="Y2/>
-                #
-                # to
-                #
-                #   <path d="MX1,Y1 LX2,Y2"/>
-
-                self.pathcount += 1
-                # if we're in resume mode AND self.pathcount < self.svgLastPath,
-                #    then skip over this path.
-                # if we're in resume mode and self.pathcount = self.svgLastPath,
-                #    then start here, and set
-                # self.nodeCount equal to self.svgLastPathNC
-
-                if self.resumeMode and ( self.pathcount == self.svgLastPath ):
-                    self.nodeCount = self.svgLastPathNC
-                if self.resumeMode and ( self.pathcount < self.svgLastPath ):
-                    pass
-                else:
-                    # Create a path to contain the line
-                    newpath = inkex.etree.Element( inkex.addNS( 'path', 'svg' ) )
-                    x1 = float( node.get( 'x1' ) )
-                    y1 = float( node.get( 'y1' ) )
-                    x2 = float( node.get( 'x2' ) )
-                    y2 = float( node.get( 'y2' ) )
-                    s = node.get( 'style' )
-                    if s:
-                        newpath.set( 'style', s )
-                    t = node.get( 'transform' )
-                    if t:
-                        newpath.set( 'transform', t )
-                    a = []
-                    a.append( ['M ', [x1, y1]] )
-                    a.append( [' L ', [x2, y2]] )
-                    newpath.set( 'd', simplepath.formatPath( a ) )
-                    self.plotPath( newpath, matNew )
-                    if ( not self.bStopped ):       #an "index" for resuming plots quickly-- record last complete path
-                        self.svgLastPath += 1
-                        self.svgLastPathNC = self.nodeCount
-
-            elif node.tag == inkex.addNS( 'polyline', 'svg' ) or node.tag == 'polyline':
-
-                # Convert
-                #
-                #  <polyline points="x1,y1 x2,y2 x3,y3 [...]"/>
-                #
-                # to
-                #
-                #   <path d="Mx1,y1 Lx2,y2 Lx3,y3 [...]"/>
-                #
-                # Note: we ignore polylines with no points
-
-                pl = node.get( 'points', '' ).strip()
-                if pl == '':
-                    pass
-
-                self.pathcount += 1
-                #if we're in resume mode AND self.pathcount < self.svgLastPath, then skip over this path.
-                #if we're in resume mode and self.pathcount = self.svgLastPath, then start here, and set
-                # self.nodeCount equal to self.svgLastPathNC
-
-                if self.resumeMode and ( self.pathcount == self.svgLastPath ):
-                    self.nodeCount = self.svgLastPathNC
-
-                if self.resumeMode and ( self.pathcount < self.svgLastPath ):
-                    pass
-
-                else:
-                    pa = pl.split()
-                    if not len( pa ):
-                        pass
-                    # Issue 29: pre 2.5.? versions of Python do not have
-                    #    "statement-1 if expression-1 else statement-2"
-                    # which came out of PEP 308, Conditional Expressions
-                    #d = "".join( ["M " + pa[i] if i == 0 else " L " + pa[i] for i in range( 0, len( pa ) )] )
-                    d = "M " + pa[0]
-                    for i in range( 1, len( pa ) ):
-                        d += " L " + pa[i]
-                    newpath = inkex.etree.Element( inkex.addNS( 'path', 'svg' ) )
-                    newpath.set( 'd', d );
-                    s = node.get( 'style' )
-                    if s:
-                        newpath.set( 'style', s )
-                    t = node.get( 'transform' )
-                    if t:
-                        newpath.set( 'transform', t )
-                    self.plotPath( newpath, matNew )
-                    if ( not self.bStopped ):       #an "index" for resuming plots quickly-- record last complete path
-                        self.svgLastPath += 1
-                        self.svgLastPathNC = self.nodeCount
-
-            elif node.tag == inkex.addNS( 'polygon', 'svg' ) or node.tag == 'polygon':
-
-                # Convert
-                #
-                #  <polygon points="x1,y1 x2,y2 x3,y3 [...]"/>
-                #
-                # to
-                #
-                #   <path d="Mx1,y1 Lx2,y2 Lx3,y3 [...] Z"/>
-                #
-                # Note: we ignore polygons with no points
-
-                pl = node.get( 'points', '' ).strip()
-                if pl == '':
-                    pass
-
-                self.pathcount += 1
-                #if we're in resume mode AND self.pathcount < self.svgLastPath, then skip over this path.
-                #if we're in resume mode and self.pathcount = self.svgLastPath, then start here, and set
-                # self.nodeCount equal to self.svgLastPathNC
-
-                if self.resumeMode and ( self.pathcount == self.svgLastPath ):
-                    self.nodeCount = self.svgLastPathNC
-
-                if self.resumeMode and ( self.pathcount < self.svgLastPath ):
-                    pass
-
-                else:
-                    pa = pl.split()
-                    if not len( pa ):
-                        pass
-                    # Issue 29: pre 2.5.? versions of Python do not have
-                    #    "statement-1 if expression-1 else statement-2"
-                    # which came out of PEP 308, Conditional Expressions
-                    #d = "".join( ["M " + pa[i] if i == 0 else " L " + pa[i] for i in range( 0, len( pa ) )] )
-                    d = "M " + pa[0]
-                    for i in range( 1, len( pa ) ):
-                        d += " L " + pa[i]
-                    d += " Z"
-                    newpath = inkex.etree.Element( inkex.addNS( 'path', 'svg' ) )
-                    newpath.set( 'd', d );
-                    s = node.get( 'style' )
-                    if s:
-                        newpath.set( 'style', s )
-                    t = node.get( 'transform' )
-                    if t:
-                        newpath.set( 'transform', t )
-                    self.plotPath( newpath, matNew )
-                    if ( not self.bStopped ):       #an "index" for resuming plots quickly-- record last complete path
-                        self.svgLastPath += 1
-                        self.svgLastPathNC = self.nodeCount
-
-            elif node.tag == inkex.addNS( 'ellipse', 'svg' ) or \
-                node.tag == 'ellipse' or \
-                node.tag == inkex.addNS( 'circle', 'svg' ) or \
-                node.tag == 'circle':
-
-                # Convert circles and ellipses to a path with two 180 degree arcs.
-                # In general (an ellipse), we convert
-                #
-                #   <ellipse rx="RX" ry="RY" cx="X" cy="Y"/>
-                #
-                # to
-                #
-                #   <path d="MX1,CY A RX,RY 0 1 0 X2,CY A RX,RY 0 1 0 X1,CY"/>
-                #
-                # where
-                #
-                #   X1 = CX - RX
-                #   X2 = CX + RX
-                #
-                # Note: ellipses or circles with a radius attribute of value 0 are ignored
-
-                if node.tag == inkex.addNS( 'ellipse', 'svg' ) or node.tag == 'ellipse':
-                    rx = float( node.get( 'rx', '0' ) )
-                    ry = float( node.get( 'ry', '0' ) )
-                else:
-                    rx = float( node.get( 'r', '0' ) )
-                    ry = rx
-                if rx == 0 or ry == 0:
-                    pass
-
-                self.pathcount += 1
-                #if we're in resume mode AND self.pathcount < self.svgLastPath, then skip over this path.
-                #if we're in resume mode and self.pathcount = self.svgLastPath, then start here, and set
-                # self.nodeCount equal to self.svgLastPathNC
-
-                if self.resumeMode and ( self.pathcount == self.svgLastPath ):
-                    self.nodeCount = self.svgLastPathNC
+            matNew = self.composeNodeTransform( matCurrent, node )
 
-                if self.resumeMode and ( self.pathcount < self.svgLastPath ):
-                    pass
-
-                else:
-                    cx = float( node.get( 'cx', '0' ) )
-                    cy = float( node.get( 'cy', '0' ) )
-                    x1 = cx - rx
-                    x2 = cx + rx
-                    d = 'M %f,%f ' % ( x1, cy ) + \
-                        'A %f,%f ' % ( rx, ry ) + \
-                        '0 1 0 %f,%f ' % ( x2, cy ) + \
-                        'A %f,%f ' % ( rx, ry ) + \
-                        '0 1 0 %f,%f' % ( x1, cy )
-                    newpath = inkex.etree.Element( inkex.addNS( 'path', 'svg' ) )
-                    newpath.set( 'd', d );
-                    s = node.get( 'style' )
-                    if s:
-                        newpath.set( 'style', s )
-                    t = node.get( 'transform' )
-                    if t:
-                        newpath.set( 'transform', t )
-                    self.plotPath( newpath, matNew )
-                    if ( not self.bStopped ):       #an "index" for resuming plots quickly-- record last complete path
-                        self.svgLastPath += 1
-                        self.svgLastPathNC = self.nodeCount
-            elif node.tag == inkex.addNS( 'metadata', 'svg' ) or node.tag == 'metadata':
-                pass
-            elif node.tag == inkex.addNS( 'defs', 'svg' ) or node.tag == 'defs':
-                pass
-            elif node.tag == inkex.addNS( 'namedview', 'sodipodi' ) or node.tag == 'namedview':
-                pass
-            elif node.tag == inkex.addNS( 'eggbot', 'svg' ) or node.tag == 'eggbot':
-                pass
-            elif node.tag == inkex.addNS( 'title', 'svg' ) or node.tag == 'title':
-                pass
-            elif node.tag == inkex.addNS( 'desc', 'svg' ) or node.tag == 'desc':
-                pass
-            elif node.tag == inkex.addNS( 'text', 'svg' ) or node.tag == 'text':
-                texts = []
-                plaintext = ''
-                if self.plotCurrentLayer:
-                    for tnode in node.iterfind('.//'): # all subtree
-                        if tnode is not None and tnode.text is not None:
-                            texts.append(tnode.text)
-                if len(texts):
-                    plaintext = "', '".join(texts).encode('latin-1')
-                    # encode_('latin-1') prevents 'ordinal not in range(128)' errors.
-                    self.log("Text ignored: '%s'" % (plaintext))
-                    plaintext = "\n".join(texts)+"\n"
-
-                    if not self.warnings.has_key( 'text' ) and self.plotCurrentLayer:
-                        inkex.errormsg( plaintext + gettext.gettext( 'Warning: unable to draw text; ' +
-                            'please convert it to a path first. Or consider using the ' +
-                            'Hershey Text extension which can be installed in the '+
-                            '"Render" category of extensions.' ) )
-                        self.warnings['text'] = 1
-                pass
-            elif node.tag == inkex.addNS( 'image', 'svg' ) or node.tag == 'image':
-                if not self.warnings.has_key( 'image' ):
-                    inkex.errormsg( gettext.gettext( 'Warning: unable to draw bitmap images; ' +
-                        'please convert them to line art first.  Consider using the "Trace bitmap..." ' +
-                        'tool of the "Path" menu.  Mac users please note that some X11 settings may ' +
-                        'cause cut-and-paste operations to paste in bitmap copies.' ) )
-                    self.warnings['image'] = 1
-                pass
-            elif node.tag == inkex.addNS( 'pattern', 'svg' ) or node.tag == 'pattern':
-                pass
-            elif node.tag == inkex.addNS( 'radialGradient', 'svg' ) or node.tag == 'radialGradient':
-                # Similar to pattern
-                pass
-            elif node.tag == inkex.addNS( 'linearGradient', 'svg' ) or node.tag == 'linearGradient':
-                # Similar in pattern
-                pass
-            elif node.tag == inkex.addNS( 'style', 'svg' ) or node.tag == 'style':
-                # This is a reference to an external style sheet and not the value
-                # of a style attribute to be inherited by child elements
-                pass
-            elif node.tag == inkex.addNS( 'cursor', 'svg' ) or node.tag == 'cursor':
-                pass
-            elif node.tag == inkex.addNS( 'flowRoot', 'svg' ) or node.tag == 'flowRoot':
-                # contains a <flowRegion><rect y="91" x="369" height="383" width="375" ...
-                # see examples/fablab_logo_stencil.svg
-                pass
-            elif node.tag == inkex.addNS( 'color-profile', 'svg' ) or node.tag == 'color-profile':
-                # Gamma curves, color temp, etc. are not relevant to single color output
-                pass
+            handler = handlers.get( node.tag )
+            if handler is not None:
+                handler( node, matNew, v )
             elif not isinstance( node.tag, basestring ):
                 # This is likely an XML processing instruction such as an XML
                 # comment.  lxml uses a function reference for such node tags
@@ -721,7 +907,439 @@ class PrepareCutting(inkex.Effect):
                     inkex.errormsg( gettext.gettext( 'Warning: unable to draw <' + str( t[-1] ) +
                         '> object, please convert it to a path first.' ) )
                     self.warnings[str( node.tag )] = 1
-                pass
+
+
+    def traverseChildren( self, aNodeList, matCurrent, parent_visibility, onExit=None ):
+        """
+        Schedule the nodes of [aNodeList] to be traversed next by
+        recursivelyTraverseSvg(), with the given transform and visibility.
+        [onExit] is called once they are all done.
+        """
+        self.traversalStack.append( ( iter( aNodeList ), matCurrent, parent_visibility, onExit ) )
+
+
+    def composeNodeTransform( self, matCurrent, node ):
+        """
+        The transform of [node] composed with [matCurrent].  Transform
+        attributes are parsed once per distinct string; nodes without a
+        transform (or with an identity one) share the matrix of their
+        parent.  The returned matrix must not be modified.
+        """
+        transform = node.get( 'transform' )
+        if not transform:
+            return matCurrent
+        mat = self.transforms.get( transform )
+        if mat is None:
+            mat = self.transforms[transform] = parseTransform( transform )
+        if mat == IDENTITY_TRANSFORM:
+            return matCurrent
+        if matCurrent == IDENTITY_TRANSFORM:
+            return mat
+        return composeTransform( matCurrent, mat )
+
+
+    def plotPathLike( self, node, matTransform, shape=None, box=None ):
+        """
+        Plot a path-like element, unless it is skipped in resume mode or
+        lies outside the page (with --offpage).  Every path-like element
+        counts as one path for resuming.
+
+        [node] is either a <path>, or [shape] is given: a function which
+        returns the outline of the element in its local coordinates as a
+        list of polylines, given the transform it will be drawn with.
+        [box] is then the bounding box of the outline in local
+        coordinates, computed without building the outline.
+        """
+        self.pathcount += 1
+
+        # if we're in resume mode AND self.pathcount <= self.svgLastPath,
+        #    then the path was exported before: skip over it, without
+        #    flattening it
+        if self.resumeMode and ( self.pathcount <= self.svgLastPath ):
+            return
+
+        if self.panelScan:
+            self.scanPanelsOf( self.elementBBox( node, matTransform, shape, box )[0] )
+            return
+
+        parsed = None
+        if self.pageRect is None:
+            onPage = True
+        elif self.panels is not None:
+            # decided in the first pass already, see scanPanelsOf()
+            onPage = self.pathcount not in self.panelOffPage
+        else:
+            with self.stats.stage( 'cull' ):
+                bbox, parsed = self.elementBBox( node, matTransform, shape, box )
+            onPage = bbox is not None and boxesOverlap( bbox, self.pageRect )
+
+        if not onPage:
+            # off the page: neither flattened nor plotted
+            self.culledCount += 1
+            self.stats.count( 'culled' )
+        else:
+            key = None
+            polylines = None
+            if self.geometryCache is not None:
+                key = geometryKey( node, matTransform, self.flat, self.minstep, self.options.backend )
+                polylines = self.geometryCache.get( key )
+
+            if polylines is not None:
+                # unchanged since the last export
+                self.plotPolylines( polylines )
+            elif shape is None:
+                self.plotPath( node, matTransform, key, parsed )
+            else:
+                with self.stats.stage( 'flatten' ):
+                    polylines = shape( matTransform )
+                with self.stats.stage( 'transform' ):
+                    polylines = [ transformPoints( matTransform, pts ) for pts in polylines ]
+                self.plotPolylines( polylines, key )
+        if ( not self.bStopped ):       #an "index" for resuming plots quickly-- record last complete path
+            self.svgLastPath += 1
+            if self.checkpointStreamed:
+                # its cuts have been handed to the writer already
+                self.svgLastPathNC = self.nodeCount + self.writer.pointcount
+                if self.checkpointEnds is not None:
+                    self.checkpointEnds.append( self.svgLastPathNC )
+                if time.time() >= self.checkpointDue:
+                    self.saveCheckpoint()
+        if self.panels is not None and self.deferred is None:
+            self.writePanels( self.pathcount )
+
+
+    def elementBBox( self, node, matTransform, shape=None, box=None ):
+        """
+        Bounding box of a path-like element (see plotPathLike()) once
+        transformed, or None if it is empty, and the parsed path data of
+        a <path>, so that it need not be parsed again for flattening.
+        For a path the box is taken over the transformed control points,
+        for other shapes it is their transformed local [box]; nothing is
+        flattened.
+        """
+        if shape is None:
+            parsed = parsePathData( node.get( 'd' ) )
+            return superPathBBox( parsed, matTransform ), parsed
+        return ( transformBBox( matTransform, box ) if box is not None else None ), None
+
+
+    def scanPanels( self ):
+        """
+        First pass over the document with --panel-length: for every panel,
+        find the last path-like element reaching into it.  Only bounding
+        boxes are computed (see elementBBox()), nothing is flattened.
+        The second pass then writes each panel as soon as that element
+        has been plotted (see writePanels()).
+        """
+        stats = self.stats
+        self.stats = NoStats()
+        self.panelScan = True
+        try:
+            self.traverseDocument()
+        finally:
+            self.panelScan = False
+            self.stats = stats
+        self.pathcount = 0
+
+
+    def scanPanelsOf( self, bbox ):
+        """
+        Record the current path-like element, with bounding box [bbox]
+        (see elementBBox()), as the last one reaching into the panels the
+        box overlaps, see scanPanels().  Whether it lies outside the page
+        (with --offpage) is recorded as well, so that the second pass
+        need not compute the box again.
+        """
+        if self.pageRect is not None and ( bbox is None or not boxesOverlap( bbox, self.pageRect ) ):
+            self.panelOffPage.add( self.pathcount )
+            return
+        if bbox is None:
+            return
+        # the flattened points are computed differently from the box:
+        # allow for rounding, so that no cut reaches a panel written already
+        margin = 1e-6 * self.panelLength
+        first = int( math.floor( ( bbox[1] - margin ) / self.panelLength ) )
+        last = int( math.floor( ( bbox[3] + margin ) / self.panelLength ) )
+        for i in range( first, last + 1 ):
+            self.panelLast[i] = self.pathcount
+
+
+    def tilePaths( self ):
+        """
+        Move the completed paths from self.paths to the panels they fall
+        in (see --panel-length), clipped at the panel borders.  Panel i
+        covers y from i to i+1 panel lengths.
+        """
+        length = self.panelLength
+        inf = float( 'inf' )
+        with self.stats.stage( 'tile' ):
+            for pts in self.paths:
+                ys = [ pt[1] for pt in pts ]
+                first = int( math.floor( min( ys ) / length ) )
+                last = int( math.floor( max( ys ) / length ) )
+                for i in range( first, last + 1 ):
+                    if first == last:
+                        pieces = [ pts ]
+                    else:
+                        pieces = clipPolyline( pts, ( -inf, i * length, inf, ( i + 1 ) * length ) )
+                    if not pieces:
+                        continue
+                    store = self.panels.get( i )
+                    if store is None:
+                        store = self.panels[i] = PathStore()
+                    for piece in pieces:
+                        store.appendPath( piece )
+            self.paths.clear()
+
+
+    def writePanels( self, pathcount=None ):
+        """
+        Write the panels no path-like element after the [pathcount]th
+        reaches into, or all panels, in the order of the panels.  The
+        cuts of a panel are ordered like those of a whole document, and
+        written relative to the top border of the panel.
+        """
+        for i in sorted( self.panels ):
+            if pathcount is not None and self.panelLast.get( i, pathcount + 1 ) > pathcount:
+                continue
+            paths = self.paths
+            self.paths = self.panels.pop( i )
+            if self.options.optimize_order or self.options.inner_first:
+                self.orderCuts()
+            with self.stats.stage( 'convert' ):
+                self.paths.convert( px2in, self.xShift, self.yShift - i * self.panelLength )
+            with self.stats.stage( 'write' ):
+                self.panelWriter.writePanel( i, self.paths )
+            self.paths = paths
+
+
+    @handles( 'g' )
+    def handleGroup( self, node, matNew, v ):
+
+        self.penUp()
+        if ( node.get( inkex.addNS( 'groupmode', 'inkscape' ) ) == 'layer' ):
+            if (node.get('style','') == 'display:none'):
+                return      # hidden, with all its sublayers
+
+            layer = self.layerIndex.get( node )
+            if layer is not None and layer.selected:
+                self.traverseChildren( node, matNew, v, self.enterLayer( layer ) )
+                return
+        if not self.inSelection:
+            # on the way to selected layers: skip everything else
+            self.traverseChildren( [ c for c in node if c in self.layerVisit ], matNew, v )
+        else:
+            self.traverseChildren( node, matNew, v )
+
+
+    @handles( 'symbol' )
+    def handleSymbol( self, node, matNew, v ):
+
+        # A <symbol> is only rendered as the target of a <use>, and then
+        # like a group.
+        if self.useStack:
+            self.penUp()
+            self.traverseChildren( node, matNew, v )
+
+
+    @handles( 'use' )
+    def handleUse( self, node, matNew, v ):
+
+        # A <use> element refers to another SVG element via an xlink:href="#blah"
+        # attribute.  We will handle the element by looking up the element with
+        # the matching id="blah" attribute in the document's id index.  We then
+        # recursively process that element after applying any necessary (x,y)
+        # translation.  A <use> which (directly or through other clones) refers
+        # to one of its own ancestors is skipped.
+        #
+        # Notes:
+        #  1. We ignore the height and width attributes as they do not apply to
+        #     path-like elements, and
+        #  2. Even if the use element has visibility="hidden", SVG still calls
+        #     for processing the referenced element.  The referenced element is
+        #     hidden only if its visibility is "inherit" or "hidden".
+
+        refid = node.get( inkex.addNS( 'href', 'xlink' ) )
+        if not refid:
+            return
+
+        # [1:] to ignore leading '#' in reference
+        refid = refid[1:]
+        refnode = self.getElementById( refid )
+        if refid in self.useStack or refnode is node or \
+                ( refnode is not None and refnode in node.iterancestors() ):
+            if not self.warnings.has_key( 'use-cycle' ):
+                inkex.errormsg( gettext.gettext( 'Warning: ignoring clone of "' + refid +
+                    '" which refers to itself.' ) )
+                self.warnings['use-cycle'] = 1
+        elif refnode is not None:
+            x = float( node.get( 'x', '0' ) )
+            y = float( node.get( 'y', '0' ) )
+            # Note: the transform has already been applied
+            if ( x != 0 ) or (y != 0 ):
+                matNew2 = composeTransform( matNew, parseTransform( 'translate(%f,%f)' % (x,y) ) )
+            else:
+                matNew2 = matNew
+            v = node.get( 'visibility', v )
+            self.stats.count( 'clones' )
+            self.useStack.append( refid )
+            self.traverseChildren( [refnode], matNew2, v, self.useStack.pop )
+
+
+    @handles( 'path' )
+    def handlePath( self, node, matNew, v ):
+
+        self.plotPathLike( node, matNew )
+
+
+    @handles( 'rect' )
+    def handleRect( self, node, matNew, v ):
+
+        # Convert
+        #
+        #    <rect x="X" y="Y" width="W" height="H"/>
+        #
+        # into the closed polyline through its four corners
+        #
+        #    (X,Y) (X+W,Y) (X+W,Y+H) (X,Y+H) (X,Y)
+
+        x = float( node.get( 'x' ) )
+        y = float( node.get( 'y' ) )
+        w = float( node.get( 'width' ) )
+        h = float( node.get( 'height' ) )
+        self.plotPathLike( node, matNew,
+            lambda m: [ [ ( x, y ), ( x + w, y ), ( x + w, y + h ), ( x, y + h ), ( x, y ) ] ],
+            pathBBox( [ ( x, y ), ( x + w, y + h ) ] ) )
+
+
+    @handles( 'line' )
+    def handleLine( self, node, matNew, v ):
+
+        # Convert
+        #
+        #   <line x1="X1" y1="Y1" x2="X2" y2="Y2/>
+        #
+        # to the polyline (X1,Y1) (X2,Y2)
+
+        x1 = float( node.get( 'x1' ) )
+        y1 = float( node.get( 'y1' ) )
+        x2 = float( node.get( 'x2' ) )
+        y2 = float( node.get( 'y2' ) )
+        self.plotPathLike( node, matNew, lambda m: [ [ ( x1, y1 ), ( x2, y2 ) ] ],
+                           pathBBox( [ ( x1, y1 ), ( x2, y2 ) ] ) )
+
+
+    @handles( 'polyline', 'polygon' )
+    def handlePolyline( self, node, matNew, v ):
+
+        # Convert
+        #
+        #  <polyline points="x1,y1 x2,y2 x3,y3 [...]"/>
+        #  <polygon points="x1,y1 x2,y2 x3,y3 [...]"/>
+        #
+        # to the polyline through the points, closed for a polygon
+        #
+        # Note: we ignore polylines and polygons with no points
+
+        pts = parsePoints( node.get( 'points', '' ) )
+        if not len( pts ):
+            return
+        if node.tag in POLYGON_TAGS:
+            pts.append( pts[0] )
+        self.plotPathLike( node, matNew, lambda m: [ pts ], pathBBox( pts ) )
+
+
+    @handles( 'ellipse', 'circle' )
+    def handleEllipse( self, node, matNew, v ):
+
+        # Convert circles and ellipses
+        #
+        #   <ellipse rx="RX" ry="RY" cx="X" cy="Y"/>
+        #
+        # to a closed polyline, with as many points as needed to stay
+        # within the tolerance once transformed (see ellipsePolyline()).
+        #
+        # Note: ellipses or circles with a radius attribute of value 0 are ignored
+
+        if node.tag in ELLIPSE_TAGS:
+            rx = float( node.get( 'rx', '0' ) )
+            ry = float( node.get( 'ry', '0' ) )
+        else:
+            rx = float( node.get( 'r', '0' ) )
+            ry = rx
+        if rx == 0 or ry == 0:
+            return
+
+        cx = float( node.get( 'cx', '0' ) )
+        cy = float( node.get( 'cy', '0' ) )
+        self.plotPathLike( node, matNew,
+            lambda m: [ ellipsePolyline( cx, cy, rx, ry, m, self.flat, self.minstep, self.stats ) ],
+            ( cx - abs( rx ), cy - abs( ry ), cx + abs( rx ), cy + abs( ry ) ) )
+
+
+    @handles( 'text' )
+    def handleText( self, node, matNew, v ):
+
+        texts = []
+        plaintext = ''
+        if not self.panelScan:
+            for tnode in node.iterfind('.//'): # all subtree
+                if tnode is not None and tnode.text is not None:
+                    texts.append(tnode.text)
+        if len(texts):
+            plaintext = "', '".join(texts).encode('latin-1')
+            # encode_('latin-1') prevents 'ordinal not in range(128)' errors.
+            self.log("Text ignored: '%s'" % (plaintext))
+            plaintext = "\n".join(texts)+"\n"
+
+            if not self.warnings.has_key( 'text' ):
+                inkex.errormsg( plaintext + gettext.gettext( 'Warning: unable to draw text; ' +
+                    'please convert it to a path first. Or consider using the ' +
+                    'Hershey Text extension which can be installed in the '+
+                    '"Render" category of extensions.' ) )
+                self.warnings['text'] = 1
+
+
+    @handles( 'image' )
+    def handleImage( self, node, matNew, v ):
+
+        if not self.warnings.has_key( 'image' ):
+            inkex.errormsg( gettext.gettext( 'Warning: unable to draw bitmap images; ' +
+                'please convert them to line art first.  Consider using the "Trace bitmap..." ' +
+                'tool of the "Path" menu.  Mac users please note that some X11 settings may ' +
+                'cause cut-and-paste operations to paste in bitmap copies.' ) )
+            self.warnings['image'] = 1
+
+
+    # metadata, defs, namedview, eggbot, title, desc: nothing to cut
+    # pattern, radialGradient, linearGradient: similar to pattern
+    # style: this is a reference to an external style sheet and not the value
+    #   of a style attribute to be inherited by child elements
+    # flowRoot: contains a <flowRegion><rect y="91" x="369" height="383" width="375" ...
+    #   see examples/fablab_logo_stencil.svg
+    # color-profile: gamma curves, color temp, etc. are not relevant to single
+    #   color output
+    @handles( 'metadata', 'defs', ( 'namedview', 'sodipodi' ), 'eggbot', 'title', 'desc',
+              'pattern', 'radialGradient', 'linearGradient', 'style', 'cursor', 'flowRoot',
+              'color-profile' )
+    def handleIgnored( self, node, matNew, v ):
+        pass
+
+
+    def getElementById( self, id ):
+
+        '''
+        Return the element with the given id, or None.  The id index of the
+        document is built once, on the first lookup, and reused afterwards.
+        '''
+
+        if self.idIndex is None:
+            self.idIndex = {}
+            for node in self.document.getroot().iter():
+                i = node.get( 'id' )
+                if i is not None and not self.idIndex.has_key( i ):
+                    self.idIndex[i] = node
+        return self.idIndex.get( id )
 
 
     def getLength( self, name, default ):
@@ -741,7 +1359,7 @@ class PrepareCutting(inkex.Effect):
             elif ( u == '' ) or ( u == 'px' ):
                 return v
             elif u == 'mm':
-                return v*90./25.4       # inverse of px2mm
+                return mm2px( v )
             elif u == '%':
                 return float( default ) * v / 100.0
             else:
@@ -784,40 +1402,540 @@ class PrepareCutting(inkex.Effect):
                     self.docTransform = parseTransform( 'scale(%f,%f)' % (sx, sy) )
 
 
+    def orderCuts( self ):
+
+        '''
+        Reorder self.paths before they are written.
+
+        With --inner-first, every path is cut before the closed paths that
+        contain it.  With --optimize-order the pen-up travel is reduced by
+        nearest neighbour ordering followed by 2-opt improvement within the
+        time budget; combined with --inner-first this is done level by
+        level, starting with the most deeply nested paths.
+        '''
+
+        if len( self.paths ) < 2:
+            return
+        self.stats.enter( 'order' )
+        cuts = list( self.paths )
+        before = travelDistance( cuts )
+
+        if self.options.inner_first:
+            parents = nestingParents( cuts )
+            children = [ [] for p in cuts ]
+            for i in range( len( parents ) ):
+                if parents[i] >= 0:
+                    children[parents[i]].append( i )
+            # nesting depth, from the roots downwards
+            depth = [ 0 ] * len( cuts )
+            stack = [ i for i in range( len( parents ) ) if parents[i] < 0 ]
+            while stack:
+                i = stack.pop()
+                for c in children[i]:
+                    depth[c] = depth[i] + 1
+                    stack.append( c )
+            if self.options.optimize_order:
+                levels = [ [] for d in range( max( depth ) + 1 ) ]
+                for i in range( len( cuts ) ):
+                    levels[depth[i]].append( cuts[i] )
+                paths = []
+                for level in reversed( levels ):
+                    start = paths[-1][-1] if paths else ( 0.0, 0.0 )
+                    level = orderPathsNearest( level, start )
+                    if self.options.optimize_time > 0:
+                        level = improvePathsTwoOpt( level,
+                            self.options.optimize_time * len( level ) / len( cuts ), start )
+                    paths += level
+            else:
+                # children before their parent, otherwise in document order
+                paths = []
+                stack = [ ( i, False ) for i in reversed( range( len( parents ) ) ) if parents[i] < 0 ]
+                while stack:
+                    i, expanded = stack.pop()
+                    if expanded:
+                        paths.append( cuts[i] )
+                    else:
+                        stack.append( ( i, True ) )
+                        stack += [ ( c, False ) for c in reversed( children[i] ) ]
+        else:
+            paths = orderPathsNearest( cuts )
+            if self.options.optimize_time > 0:
+                paths = improvePathsTwoOpt( paths, self.options.optimize_time )
+
+        self.paths = PathStore( paths )
+        after = travelDistance( paths )
+        self.stats.leave()
+        self.log("Pen-up travel: %.1f mm before, %.1f mm after ordering" % (px2mm(before), px2mm(after)))
+
+
     def effect(self):
         if self.options.version:
             print __version__
             sys.exit(0)
     
-        # Viewbox handling
-        self.handleViewBox()
-        # Build a list of the vertices for the document's graphical elements
+        if self.options.backend == 'numpy' and loadNumpy() is None:
+            self.log("NumPy not available, using the pure Python backend")
+
+        self.resetState()
+        self.setupTolerances()
+        if self.options.output:
+            self.dumpname = self.options.output
+        else:
+            import tempfile
+            self.dumpname = os.path.join(tempfile.gettempdir(), "silhouette.dump")
+        if self.options.cache:
+            self.geometryCache = GeometryCache( self.dumpname + '.cache', self.options.cache_size * 1024 * 1024 )
+        if self.options.checkpoint or self.options.resume:
+            self.setupCheckpoint()
+        if self.options.layers or self.options.split_layers:
+            self.buildLayerIndex()
+
+        # the offsets, and with --autocrop the translation of the top left
+        # corner of the cuts to the origin, are applied in writePaths()
+        self.xShift = mm2px( self.options.x_off )
+        self.yShift = mm2px( self.options.y_off )
+        self.panelLength = mm2px( self.options.panel_length )
+
+        writerclass = CUT_WRITERS[self.options.format]
+        if self.options.split_layers:
+            if self.panelLength > 0:
+                inkex.errormsg( gettext.gettext( 'Error: --split-layers cannot be combined with --panel-length.' ) )
+                sys.exit(1)
+            # cuts outside of layers still go to the dump itself
+            self.layerOutputs = {}
+        if self.panelLength > 0:
+            # one dump per panel, written by writePanels()
+            o = None
+            writer = self.panelWriter = PanelCutWriter( writerclass, self.dumpname )
+            self.panels = {}
+        else:
+            o = open(self.dumpname, writerclass.mode)
+            writer = writerclass(o)
+        try:
+            if self.panels is None and not ( self.options.optimize_order or self.options.inner_first or self.options.autocrop ):
+                # stream the cuts out in document order
+                self.writer = writer
+
+            if self.options.jobs > 1:
+                # collect the paths during traversal, flatten them in parallel
+                self.deferred = []
+            # without streaming, nothing is written before the traversal is done
+            self.checkpointStreamed = self.checkpointing and self.writer is not None and \
+                self.deferred is None and self.layerOutputs is None
+            if not self.checkpointStreamed:
+                self.checkpointEnds = None
+
+            # Viewbox handling
+            with self.stats.stage( 'viewbox' ):
+                self.handleViewBox()
+            if self.options.offpage != 'keep' and self.docWidth is not None and self.docHeight is not None:
+                self.pageRect = ( 0.0, 0.0, self.docWidth, self.docHeight )
+                if self.options.offpage == 'clip':
+                    self.clipRect = self.pageRect
+            if self.panels is not None:
+                with self.stats.stage( 'tile' ):
+                    self.scanPanels()
+            try:
+                # Build a list of the vertices for the document's graphical elements
+                with self.stats.stage( 'traverse' ):
+                    self.traverseDocument()
+                if self.deferred is not None:
+                    self.plotDeferred()
+            except:
+                # interrupted: record how far the streamed cuts got
+                if self.checkpointing:
+                    self.saveCheckpoint()
+                raise
+
+            self.writer = None
+            outputs = [ ( self.paths, writer ) ]
+            if self.layerOutputs is not None:
+                outputs += [ ( output.paths, output.writer ) for output in self.layerOutputs.values() ]
+            if self.panels is not None:
+                self.writePanels()
+            else:
+                if self.options.autocrop:
+                    # the same translation for all layers, so that they stay aligned
+                    xmin = min( paths.xmin for paths, w in outputs )
+                    ymin = min( paths.ymin for paths, w in outputs )
+                    if xmin < float( 'inf' ):
+                        self.xShift -= xmin
+                        self.yShift -= ymin
+                for self.paths, w in outputs:
+                    if self.options.optimize_order or self.options.inner_first:
+                        self.orderCuts()
+                    self.writePaths(w)
+            with self.stats.stage( 'write' ):
+                for paths, w in outputs:
+                    w.close()
+        finally:
+            if o is not None:
+                o.close()
+            for output in ( self.layerOutputs or {} ).values():
+                output.f.close()
+        pointcount = self.pointcount = sum( w.pointcount for paths, w in outputs )
+        if self.checkpointing:
+            self.svgLastPathNC = self.nodeCount + pointcount
+            self.saveCheckpoint( complete=True )
+        if self.geometryCache is not None:
+            with self.stats.stage( 'cache' ):
+                self.geometryCache.save()
+
+        if self.panelWriter is not None:
+            self.log("%d panels written next to %s (%d points)" % (len(self.panelWriter.written),
+                self.dumpname, pointcount))
+        else:
+            self.log("Dump written to %s (%d points)" % (self.dumpname, writer.pointcount))
+        for position, output in sorted( ( self.layerOutputs or {} ).items() ):
+            self.log("Layer '%s' written to %s (%d points)" % (output.layer.label, output.dumpname,
+                output.writer.pointcount))
+        if self.resumeMode:
+            self.log("Resumed after %d elements (%d points)" % self.checkpointStart)
+        if self.pageRect is not None:
+            self.log("Skipped %d elements outside the page" % self.culledCount)
+        if self.minstep > 0 and self.stats.counters.get( 'step limited' ):
+            saved = self.stats.counters.get( 'step saved', 0 )
+            self.log("Step resolution: %d curve pieces not subdivided further, %d points instead of %d" %
+                     (self.stats.counters['step limited'], pointcount, pointcount + saved))
+        if self.options.simplify > 0:
+            self.log("Simplified from %d to %d points" % (self.simplifyPointsIn, self.simplifyPointsOut))
+        if self.cloneCacheHits or self.cloneCacheMisses:
+            self.log("Clone cache: %d hits, %d misses" % (self.cloneCacheHits, self.cloneCacheMisses))
+        if self.geometryCache is not None:
+            self.log("Geometry cache: %d of %d elements unchanged" % (self.geometryCache.hits,
+                self.geometryCache.hits + self.geometryCache.misses))
+        if not isinstance( self.stats, NoStats ):
+            self.writeStats( sum( w.pathcount for paths, w in outputs ), pointcount )
+
+    def traverseDocument( self ):
+        '''
+        Traverse the selected objects, or the entire document.  With
+        --layers only the selected layers are traversed.
+        '''
         if self.options.ids:
-            # Traverse the selected objects
+            # Traverse the selected objects, as part of their layer (or
+            # as the layer, if they are one)
             for id in self.options.ids:
-                self.recursivelyTraverseSvg( [self.selected[id]], self.docTransform )
+                node = self.selected[id]
+                layer = self.layerIndex.get( node )
+                if layer is None:
+                    layer = self.layerOf( node )
+                if layer is None:
+                    self.recursivelyTraverseSvg( [node], self.docTransform )
+                elif layer.selected:
+                    leave = self.enterLayer( layer )
+                    self.recursivelyTraverseSvg( [node], self.docTransform )
+                    leave()
+                elif node in self.layerVisit:
+                    # on the way to selected sublayers, see handleGroup()
+                    self.inSelection = False
+                    self.recursivelyTraverseSvg( [node], self.docTransform )
+                    self.inSelection = True
+        elif self.layerVisit is not None:
+            # Traverse the selected layers, see handleGroup()
+            self.inSelection = False
+            root = self.document.getroot()
+            self.recursivelyTraverseSvg( [ c for c in root if c in self.layerVisit ], self.docTransform )
+            self.inSelection = True
         else:
             # Traverse the entire document
             self.recursivelyTraverseSvg( self.document.getroot(), self.docTransform )
-    
-        cuts = []
-        pointcount = 0
-        for px_path in self.paths:
-            mm_path = []
-            for pt in px_path:
-                mm_path.append((px2in(pt[0]), px2in(pt[1])))
-                pointcount += 1
-            cuts.append(mm_path)
-
-        result = {}
-        result['cuts'] = cuts
-        result['pointcount'] = pointcount
-        with open(self.dumpname, 'w') as o:
-            json.dump(result, o)
-
-        self.log("Dump written to %s (%d points)" % (self.dumpname, pointcount))
+
+    def buildLayerIndex( self ):
+        '''
+        Index the layers of the document (see Layer), once per export,
+        and mark the layers selected with --layers, with their sublayers.
+        The selected layers and all their ancestors make up
+        self.layerVisit, the only elements traversed on the way to them.
+        '''
+        keys = [ key.strip() for key in self.options.layers.split( ',' ) if key.strip() ]
+        layers = []
+        for node in self.document.getroot().iter( *GROUP_TAGS ):
+            if node.get( inkex.addNS( 'groupmode', 'inkscape' ) ) == 'layer':
+                layer = Layer( node, len( layers ) + 1 )
+                self.layerIndex[node] = layer
+                layers.append( layer )
+        if not keys:
+            return
+
+        self.layerVisit = set()
+        matched = set()
+        for layer in layers:        # parents come before their sublayers
+            parent = self.layerOf( layer.node )
+            keyed = [ key for key in keys if layer.matches( key ) ]
+            matched.update( keyed )
+            layer.selected = bool( keyed ) or ( parent is not None and parent.selected )
+            if keyed and not ( parent is not None and parent.selected ):
+                self.layerVisit.add( layer.node )
+                self.layerVisit.update( layer.node.iterancestors() )
+        for key in keys:
+            if key not in matched:
+                inkex.errormsg( gettext.gettext( 'Warning: there is no layer "' + key + '".' ) )
+
+    def layerOf( self, node ):
+        '''
+        The innermost layer containing [node], or None.
+        '''
+        for parent in node.iterancestors():
+            layer = self.layerIndex.get( parent )
+            if layer is not None:
+                return layer
+        return None
+
+    def enterLayer( self, layer ):
+        '''
+        Make [layer] the current layer, with --split-layers also for the
+        cuts plotted from now on.  Returns the function switching back to
+        the previous layer, called when the layer has been traversed.
+        '''
+        state = ( self.currentLayer, self.inSelection, self.paths, self.writer )
+        self.currentLayer = layer
+        self.inSelection = True
+        if self.layerOutputs is not None:
+            output = self.layerOutputs.get( layer.position )
+            if output is None:
+                root, ext = os.path.splitext( self.dumpname )
+                output = self.layerOutputs[layer.position] = LayerOutput( layer,
+                    '%s.layer%d%s' % ( root, layer.position, ext ), CUT_WRITERS[self.options.format] )
+            self.paths = output.paths
+            if self.writer is not None:
+                self.writer = output.writer
+
+        def leave():
+            self.currentLayer, self.inSelection, self.paths, self.writer = state
+        return leave
+
+    def setupCheckpoint( self ):
+        '''
+        Prepare checkpointing (see saveCheckpoint()) and with --resume,
+        continue after the elements recorded in the checkpoint of the
+        same document: plotPathLike() skips them without flattening, so
+        the dump only holds the remaining cuts.  The checkpoint must have
+        been written with the same options.
+        '''
+        import json
+        self.checkpointing = True
+        self.checkpointName = self.dumpname + '.checkpoint'
+        self.documentHash = documentHash( self.document.getroot(), self.options )
+        self.checkpointEnds = []
+        self.checkpointDue = time.time() + CHECKPOINT_INTERVAL
+        if not self.options.resume:
+            return
+
+        try:
+            with open( self.checkpointName ) as f:
+                checkpoint = json.load( f )
+        except ( IOError, ValueError ):
+            self.log("No checkpoint in %s, exporting everything" % self.checkpointName)
+            return
+        if checkpoint.get( 'version' ) != CHECKPOINT_VERSION or checkpoint.get( 'document' ) != self.documentHash:
+            inkex.errormsg( gettext.gettext( 'Error: the checkpoint ' + self.checkpointName +
+                ' was written for another document, with other options, or by another version; ' +
+                'cannot resume.' ) )
+            sys.exit(1)
+
+        ends = checkpoint.get( 'ends' )
+        if self.options.resume_points >= 0:
+            # how far the cutter got: into the element these points end in
+            if ends is None:
+                inkex.errormsg( gettext.gettext( 'Error: the cuts of the previous dump were not ' +
+                    'in document order; cannot resume from a point offset.' ) )
+                sys.exit(1)
+            path = bisect.bisect_right( ends, checkpoint['start'][1] + self.options.resume_points )
+            path = min( path, checkpoint['path'] )
+            points = ends[path - 1] if path else 0
+        else:
+            path = checkpoint['path']
+            points = checkpoint['points']
+
+        self.resumeMode = True
+        self.svgLastPath = path
+        self.svgLastPathNC = self.nodeCount = points
+        self.checkpointStart = ( path, points )
+        if ends is not None and len( ends ) >= path:
+            self.checkpointEnds = ends[:path]
+        else:
+            self.checkpointEnds = None
+
+    def saveCheckpoint( self, complete=False ):
+        '''
+        Write the checkpoint: a hash of the document, and the number of
+        path-like elements whose cuts have been written, with the total
+        number of points up to their end.  While the cuts are streamed out
+        in document order, it is written every CHECKPOINT_INTERVAL seconds
+        and when the export is interrupted, and it also lists the points
+        up to the end of every element, so that --resume-points can map
+        the progress of a cutter back to an element.
+        '''
+        import json
+        if complete or self.checkpointStreamed:
+            path, points = self.svgLastPath, self.svgLastPathNC
+            if self.writer is not None:
+                # everything counted is on disk
+                self.writer.f.flush()
+        else:
+            path, points = self.checkpointStart
+        checkpoint = {
+            'version': CHECKPOINT_VERSION,
+            'document': self.documentHash,
+            'start': self.checkpointStart,
+            'path': path,
+            'points': points,
+            'complete': complete,
+        }
+        if self.checkpointEnds is not None:
+            checkpoint['ends'] = self.checkpointEnds
+        writeAtomically( self.checkpointName,
+                         lambda f: json.dump( checkpoint, f, separators=( ',', ':' ) ), 'w' )
+        self.checkpointDue = time.time() + CHECKPOINT_INTERVAL
+
+    def writeStats( self, pathcount, pointcount ):
+        '''
+        Write the stage timings and counters of this export, which wrote
+        [pathcount] cuts with [pointcount] points, as JSON next to the dump.
+        '''
+        self.stats.count( 'paths', pathcount )
+        self.stats.count( 'points', pointcount )
+        self.stats.count( 'clone cache hits', self.cloneCacheHits )
+        self.stats.count( 'clone cache misses', self.cloneCacheMisses )
+        if self.geometryCache is not None:
+            self.stats.count( 'geometry cache hits', self.geometryCache.hits )
+            self.stats.count( 'geometry cache misses', self.geometryCache.misses )
+        report = self.stats.report()
+        report['version'] = __version__
+        report['input'] = self.args[-1] if self.args else None
+        report['dump'] = self.dumpname
+        statsname = self.dumpname + '.stats.json'
+        import json
+        with open( statsname, 'w' ) as f:
+            json.dump( report, f, indent=1, sort_keys=True )
+        self.log("Stats written to %s (%.3f s in total)" % (statsname, report['total']))
+
+    def exportFile( self, filename, dumpname ):
+        '''
+        Export the SVG file [filename] to [dumpname] with the options
+        already set up, like affect() does for the single document given
+        on the command line.  Returns an error message, or None.
+        '''
+        self.args = [ filename ]
+        self.options.output = dumpname
+        try:
+            self.parse( filename )
+            self.getposinbody()
+            self.getselected()
+            self.getdocids()
+            self.effect()
+        except ( Exception, SystemExit ) as e:
+            return str( e ) or e.__class__.__name__
+        return None
+
+
+def batchInputs( args ):
+
+    """
+    The SVG files to export in batch mode: the files given, the *.svg
+    files in the directories given, and the file names read from stdin
+    for an argument '-'.
+    """
+
+    filenames = []
+    for arg in args:
+        if arg == '-':
+            filenames += [ line.strip() for line in sys.stdin if line.strip() ]
+        elif os.path.isdir( arg ):
+            filenames += sorted( os.path.join( arg, f ) for f in os.listdir( arg )
+                                 if f.lower().endswith( '.svg' ) )
+        else:
+            filenames.append( arg )
+    return filenames
+
+
+def batchOutputs( filenames, outdir, format ):
+
+    """
+    A dump file name for every input file: the input file name with the
+    extension replaced by the format, in [outdir] if given.  Names are
+    made unique by appending a number.
+    """
+
+    dumpnames = []
+    used = set()
+    for filename in filenames:
+        base = os.path.splitext( filename )[0]
+        if outdir:
+            base = os.path.join( outdir, os.path.basename( base ) )
+        dumpname = base + '.' + format
+        n = 1
+        while dumpname in used:
+            n += 1
+            dumpname = '%s-%d.%s' % ( base, n, format )
+        used.add( dumpname )
+        dumpnames.append( dumpname )
+    return dumpnames
+
+
+# The PrepareCutting instance of a batch worker process, see batchMain()
+batchEffect = None
+
+def batchWorkerInit( options ):
+    global batchEffect
+    batchEffect = PrepareCutting()
+    batchEffect.options = options
+    batchEffect.tty = sys.stderr
+
+def batchWorkerExport( item ):
+    filename, dumpname = item
+    error = batchEffect.exportFile( filename, dumpname )
+    return filename, dumpname, batchEffect.pointcount, error
+
+
+def batchMain( argv ):
+
+    """
+    Headless batch mode (--batch): export many files with one process, or
+    with a pool of --jobs worker processes, reusing the set up extension
+    for every file.  Reports one line per file on stdout and returns the
+    exit status: 1 if any file failed.
+    """
+
+    e = PrepareCutting()
+    e.getoptions( argv )
+    options = e.options
+    filenames = batchInputs( e.args )
+    if options.outdir and not os.path.isdir( options.outdir ):
+        os.makedirs( options.outdir )
+    work = zip( filenames, batchOutputs( filenames, options.outdir, options.format ) )
+
+    jobs = options.jobs
+    options.jobs = 1        # files are exported in parallel instead
+    if jobs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool( jobs, batchWorkerInit, ( options, ) )
+        results = pool.imap( batchWorkerExport, work )
+    else:
+        pool = None
+        batchWorkerInit( options )
+        results = ( batchWorkerExport( item ) for item in work )
+
+    failed = 0
+    try:
+        for filename, dumpname, pointcount, error in results:
+            if error is None:
+                print "%s -> %s (%d points)" % ( filename, dumpname, pointcount )
+            else:
+                print >>sys.stderr, "%s: %s" % ( filename, error )
+                failed += 1
+            sys.stdout.flush()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return 1 if failed else 0
+
     
 if __name__ == '__main__':
+    if '--batch' in sys.argv[1:]:
+        sys.exit( batchMain( sys.argv[1:] ) )
     e = PrepareCutting()
     e.affect()
     sys.exit(0)    # helps to keep the selection